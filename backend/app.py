@@ -1,26 +1,34 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
+import click
 from flask_cors import CORS
 import psycopg2
 import psycopg2.extras
+from psycopg2.pool import PoolError
 import yaml
 import json
 import re
+import os
+import tempfile
 from pathlib import Path
 from datetime import datetime
 
+from services.db import get_conn, execute_prepared, prepared_stats, layer_versions, ensure_layer_versioning, track_layer
+from services.httpcache import make_etag, not_modified, cacheable, compress, cache_stats
+from services.display_geom import DISPLAY_GEOM_COL, detect_display_col, ensure_display_geom
+from services.admission import admitted, coalesced, geometry_cost, admission_stats
+from services.advisor import audit, fix
+from services.engine import HazardEngine
+from services.stats import ensure_stats_tables, refresh_layer, mark_layer, stale_layers, drop_layer
+from services.projects_import import ensure_import_tables, detect_format, read_projects, import_projects
+from services.export import FORMATS, MAX_QUERY_FEATURES, check_format, geom_select, layer_export, query_export, export_stats
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["ETag"])
+app.after_request(compress)
 
 DB_SRID = 23033      # SRID dati PAI in PostGIS
 INPUT_SRID = 4326    # SRID Leaflet (lat/lon)
 
-DB = {
-    "host": "db",
-    "dbname": "gis",
-    "user": "postgres",
-    "password": "password",
-}
-
 RULES_PATH = Path("/app/rules/rule_matrix.yaml")
 
 PREFERRED_CLASS_COLS = [
@@ -34,10 +42,6 @@ PREFERRED_CLASS_COLS = [
 SAFE_IDENT = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
 
 
-def get_conn():
-    return psycopg2.connect(**DB)
-
-
 def load_rules():
     if not RULES_PATH.exists():
         return {}
@@ -76,13 +80,14 @@ def detect_geom_col(cur, table: str):
         SELECT f_geometry_column
         FROM public.geometry_columns
         WHERE f_table_schema='public' AND f_table_name=%s
+          AND f_geometry_column <> %s
         LIMIT 1
-    """, (table,))
+    """, (table, DISPLAY_GEOM_COL))
     r = cur.fetchone()
     if r and r[0]:
         return r[0]
 
-    cols = list_columns(cur, table)
+    cols = [c for c in list_columns(cur, table) if c[0] != DISPLAY_GEOM_COL]
     for name, udt in cols:
         if udt == "geometry":
             return name
@@ -94,6 +99,18 @@ def detect_geom_col(cur, table: str):
     return None
 
 
+def detect_pk_col(cur, table: str):
+    cur.execute("""
+        SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+    """, (table,))
+    rows = cur.fetchall()
+    # ogr2ogr crea ogc_fid come PK; chiavi composte non servono come id feature
+    return rows[0][0] if len(rows) == 1 else None
+
+
 def detect_class_col(cur, table: str):
     cols = [c[0] for c in list_columns(cur, table)]
     lower_map = {c.lower(): c for c in cols}
@@ -117,23 +134,87 @@ def pick_studio_from_value(value) -> str:
     return "idraulico"
 
 
-def discover_tables_for_basin(cur, basin_name: str, cfg: dict):
+def basin_prefix(basin_name: str, cfg: dict) -> str:
     # Se in YAML metti table_prefix: pai_trigno__ allora usa quello.
     # Altrimenti default: pai_<bacino>__
-    prefix = cfg.get("table_prefix")
-    if not prefix:
-        prefix = f"pai_{basin_name.lower()}__"
+    return cfg.get("table_prefix") or f"pai_{basin_name.lower()}__"
+
+
+def discover_tables_for_basin(cur, basin_name: str, cfg: dict):
+    prefix = basin_prefix(basin_name, cfg)
 
     cur.execute("""
         SELECT f_table_name
         FROM public.geometry_columns
         WHERE f_table_schema='public'
           AND f_table_name LIKE %s
+          AND f_geometry_column <> %s
         ORDER BY f_table_name
-    """, (prefix + "%",))
+    """, (prefix + "%", DISPLAY_GEOM_COL))
     return [r[0] for r in cur.fetchall()]
 
 
+def list_pai_tables(cur):
+    cur.execute("""
+        SELECT f_table_name
+        FROM public.geometry_columns
+        WHERE f_table_schema='public' AND f_table_name LIKE 'pai_%%'
+          AND f_geometry_column <> %s
+        ORDER BY f_table_name
+    """, (DISPLAY_GEOM_COL,))
+    return [r[0] for r in cur.fetchall()]
+
+
+def describe_engine_layer(cur, table: str):
+    geom_col = detect_geom_col(cur, table)
+    class_col = detect_class_col(cur, table)
+    if not geom_col or not class_col:
+        return None
+    # mai la colonna display: può essere semplificata, /analyze usa sempre geom
+    return f"ST_Transform({safe_ident(geom_col)}, 4326)", safe_ident(class_col)
+
+
+hazard_engine = HazardEngine(list_pai_tables, describe_engine_layer)
+
+
+def ensure_layer_versions():
+    # ETag, export, snapshot del motore e /stats dipendono dalla versione dati dei layer
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            ensure_layer_versioning(cur)
+            for table in list_pai_tables(cur):
+                track_layer(cur, table)
+            conn.commit()
+
+ensure_layer_versions()
+
+
+def _payload():
+    return request.get_json(silent=True) or {}
+
+
+def analyze_cost():
+    p = _payload()
+    geometry = p.get("geometry") or (p if p.get("type") == "FeatureCollection" else None)
+    return geometry_cost(geometry)
+
+
+def intersections_cost():
+    p = _payload()
+    return geometry_cost(p.get("geometry")) * max(1.0, int(p.get("limit", 500)) / 500.0)
+
+
+def features_cost():
+    # una pagina del feature worker (3000 righe) costa 1: le sue 4 richieste parallele stanno nel budget
+    return max(1.0, int(request.args.get("limit", "200")) / 5000.0)
+
+
+@app.errorhandler(PoolError)
+def handle_pool_exhausted(e):
+    # nessuna connessione libera entro DB_POOL_WAIT_MS: risposta rapida invece di accodare
+    return jsonify({"ok": False, "error": "Database sovraccarico, riprova", "type": "PoolError"}), 503, {"Retry-After": "2"}
+
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     return jsonify({"ok": False, "error": str(e), "type": e.__class__.__name__}), 500
@@ -144,6 +225,21 @@ def health():
     return jsonify({"ok": True})
 
 
+@app.get("/db_stats")
+def db_stats():
+    """Statement preparati: prepare/execute per tipo di query e piani generic/custom della sessione."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            stats = prepared_stats(cur)
+    return jsonify({"ok": True, **stats, "engine": hazard_engine.stats(), "admission": admission_stats()})
+
+
+@app.get("/cache_stats")
+def http_cache_stats():
+    """Richieste condizionali (304 = hit) e compressione per endpoint."""
+    return jsonify({"ok": True, "endpoints": cache_stats(), "exports": export_stats()})
+
+
 @app.get("/tables")
 def tables():
     with get_conn() as conn:
@@ -151,18 +247,27 @@ def tables():
             cur.execute("""
                 SELECT f_table_name, f_geometry_column, srid, type
                 FROM public.geometry_columns
-                WHERE f_table_schema='public' AND f_table_name LIKE 'pai_%'
+                WHERE f_table_schema='public' AND f_table_name LIKE 'pai_%%'
+                  AND f_geometry_column <> %s
                 ORDER BY f_table_name
-            """)
+            """, (DISPLAY_GEOM_COL,))
             rows = cur.fetchall()
+            versions = layer_versions(cur, [r[0] for r in rows])
 
     out = []
     for t, g, srid, typ in rows:
-        out.append({"table": t, "geom_col": g, "srid": int(srid), "type": typ})
-    return jsonify({"ok": True, "tables": out})
+        # version: il frontend invalida la propria cache (IndexedDB) quando cambia
+        out.append({"table": t, "geom_col": g, "srid": int(srid), "type": typ, "version": versions.get(t)})
+
+    etag = make_etag({}, out)
+    if not_modified(etag):
+        return cacheable(Response(status=304), etag)
+    return cacheable(jsonify({"ok": True, "tables": out}), etag)
 
 
 @app.get("/table_extent")
+@coalesced
+@admitted("table_extent", 4)
 def table_extent():
     table = request.args.get("table", "")
     table = safe_ident(table)
@@ -172,16 +277,22 @@ def table_extent():
             if not table_exists(cur, table):
                 return jsonify({"ok": False, "error": "table not found"}), 404
 
+            etag = make_etag(layer_versions(cur, [table]), "extent", table)
+            if not_modified(etag):
+                return cacheable(Response(status=304), etag)
+
             geom_col = detect_geom_col(cur, table)
             if not geom_col:
                 return jsonify({"ok": False, "error": "geom column not found"}), 400
 
             geom_col = safe_ident(geom_col)
+            display_col = detect_display_col(cur, table)
+            geom_4326 = display_col or f"ST_Transform({geom_col}, 4326)"
             cur.execute(f"""
                 SELECT
                   ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
                 FROM (
-                  SELECT ST_Extent(ST_Transform({geom_col}, 4326))::box2d AS e
+                  SELECT ST_Extent({geom_4326})::box2d AS e
                   FROM {table}
                   WHERE {geom_col} IS NOT NULL
                 ) s
@@ -191,10 +302,12 @@ def table_extent():
     if not r or any(v is None for v in r):
         return jsonify({"ok": False, "error": "empty extent"}), 200
 
-    return jsonify({"ok": True, "bbox4326": [r[0], r[1], r[2], r[3]]})
+    return cacheable(jsonify({"ok": True, "bbox4326": [r[0], r[1], r[2], r[3]]}), etag)
 
 
 @app.get("/features")
+@coalesced
+@admitted("features", 8, features_cost)
 def features():
     table = request.args.get("table", "")
     table = safe_ident(table)
@@ -214,6 +327,10 @@ def features():
             if not table_exists(cur, table):
                 return jsonify({"ok": False, "error": "table not found"}), 404
 
+            etag = make_etag(layer_versions(cur, [table]), "features", table, limit, offset, bbox_vals)
+            if not_modified(etag):
+                return cacheable(Response(status=304), etag)
+
             geom_col = detect_geom_col(cur, table)
             if not geom_col:
                 return jsonify({"ok": False, "error": "geom column not found"}), 400
@@ -222,53 +339,66 @@ def features():
             class_col = detect_class_col(cur, table)
             class_col = safe_ident(class_col) if class_col else None
 
+            display_col = detect_display_col(cur, table)
+
+            pk_col = detect_pk_col(cur, table)
+            fid_sql = f"{safe_ident(pk_col)}::text" if pk_col else "ctid::text"
+            # ordine stabile: senza ORDER BY le pagine LIMIT/OFFSET possono sovrapporsi o saltare righe
+            order_sql = safe_ident(pk_col) if pk_col else "ctid"
+
+            cls_sql = class_col if class_col else "NULL"
             where = [f"{geom_col} IS NOT NULL"]
             params = []
+            types = []
+            kind = "features"
 
             if bbox_vals:
-                # bbox in 4326 -> trasformo in DB_SRID e uso && per velocità
-                where.append(f"{geom_col} && ST_Transform(ST_MakeEnvelope(%s,%s,%s,%s,4326), {DB_SRID})")
+                if display_col:
+                    # colonna display già in 4326: && diretto sul suo indice GiST
+                    where.append(f"{display_col} && ST_MakeEnvelope($1,$2,$3,$4,4326)")
+                else:
+                    # bbox in 4326 -> trasformo in DB_SRID e uso && per velocità
+                    where.append(f"{geom_col} && ST_Transform(ST_MakeEnvelope($1,$2,$3,$4,4326), {DB_SRID})")
                 params.extend(bbox_vals)
+                types.extend(["float8"] * 4)
+                kind = "features_bbox"
 
             where_sql = " AND ".join(where)
-
-            if class_col:
-                sql = f"""
-                  SELECT
-                    ST_AsGeoJSON(ST_Transform({geom_col}, 4326), 6) AS g,
-                    {class_col} AS cls
-                  FROM {table}
-                  WHERE {where_sql}
-                  LIMIT %s OFFSET %s
-                """
-            else:
-                sql = f"""
-                  SELECT
-                    ST_AsGeoJSON(ST_Transform({geom_col}, 4326), 6) AS g,
-                    NULL AS cls
-                  FROM {table}
-                  WHERE {where_sql}
-                  LIMIT %s OFFSET %s
-                """
+            n = len(params)
+            geom_4326 = display_col or f"ST_Transform({geom_col}, 4326)"
+
+            sql = f"""
+              SELECT
+                ST_AsGeoJSON({geom_4326}, 6) AS g,
+                {cls_sql} AS cls,
+                {fid_sql} AS fid
+              FROM {table}
+              WHERE {where_sql}
+              ORDER BY {order_sql}
+              LIMIT ${n + 1} OFFSET ${n + 2}
+            """
 
             params.extend([limit, offset])
-            cur.execute(sql, tuple(params))
-            rows = cur.fetchall()
+            types.extend(["integer", "integer"])
+            rows = execute_prepared(cur, table, kind, sql, params, types)
 
     fc = {"type": "FeatureCollection", "features": []}
-    for g, cls in rows:
+    for g, cls, fid in rows:
         if not g:
             continue
         fc["features"].append({
             "type": "Feature",
+            "id": fid,
             "geometry": json.loads(g),
             "properties": {"class": cls}
         })
 
-    return jsonify({"ok": True, "fc": fc, "count": len(fc["features"])})
+    return cacheable(jsonify({"ok": True, "fc": fc, "count": len(fc["features"])}), etag)
 
 
 @app.post("/analyze")
+@coalesced
+@admitted("analyze", 8, analyze_cost)
 def analyze():
     rules = load_rules()
     payload = request.get_json(silent=True) or {}
@@ -289,37 +419,50 @@ def analyze():
 
     hits = []
     with get_conn() as conn:
+        # punti / linee corte: risposta dal motore in memoria, senza query per layer
+        engine_hits = hazard_engine.query(conn, geometry)
+
         with conn.cursor() as cur:
 
             for bacino, cfg in (rules or {}).items():
+                # colonne forzate da YAML: il motore usa quelle rilevate, quindi PostGIS
+                use_engine = engine_hits is not None and not cfg.get("geom_col") and not cfg.get("class_col")
+
                 # se manca bacino in YAML, non lo analizziamo
-                tables = discover_tables_for_basin(cur, bacino, cfg)
+                if use_engine:
+                    prefix = basin_prefix(bacino, cfg)
+                    tables = sorted(t for t in engine_hits if t.startswith(prefix))
+                else:
+                    tables = discover_tables_for_basin(cur, bacino, cfg)
 
                 for table in tables:
-                    if not table_exists(cur, table):
-                        continue
-
-                    geom_col = cfg.get("geom_col") or detect_geom_col(cur, table)
-                    class_col = cfg.get("class_col") or detect_class_col(cur, table)
-                    if not geom_col or not class_col:
-                        continue
-
-                    geom_col = safe_ident(geom_col)
-                    class_col = safe_ident(class_col)
-
-                    cur.execute(f"""
-                        SELECT DISTINCT {class_col}
-                        FROM {table}
-                        WHERE ST_Intersects(
-                            {geom_col},
-                            ST_Transform(
-                              ST_SetSRID(ST_GeomFromGeoJSON(%s), {INPUT_SRID}),
-                              {DB_SRID}
+                    if use_engine:
+                        classes = engine_hits[table]
+                    else:
+                        if not table_exists(cur, table):
+                            continue
+
+                        geom_col = cfg.get("geom_col") or detect_geom_col(cur, table)
+                        class_col = cfg.get("class_col") or detect_class_col(cur, table)
+                        if not geom_col or not class_col:
+                            continue
+
+                        geom_col = safe_ident(geom_col)
+                        class_col = safe_ident(class_col)
+
+                        rows = execute_prepared(cur, table, "analyze", f"""
+                            SELECT DISTINCT {class_col}
+                            FROM {table}
+                            WHERE ST_Intersects(
+                                {geom_col},
+                                ST_Transform(
+                                  ST_SetSRID(ST_GeomFromGeoJSON($1), {INPUT_SRID}),
+                                  {DB_SRID}
+                                )
                             )
-                        )
-                    """, (geom_json,))
+                        """, [geom_json], ["text"])
 
-                    classes = [r[0] for r in cur.fetchall() if r and r[0] is not None]
+                        classes = [r[0] for r in rows if r and r[0] is not None]
                     if not classes:
                         continue
 
@@ -356,6 +499,8 @@ def analyze():
 
 
 @app.post("/intersections")
+@coalesced
+@admitted("intersections", 6, intersections_cost)
 def intersections():
     """
     Ritorna le geometrie dei poligoni PAI che intersecano la geometria disegnata.
@@ -376,18 +521,16 @@ def intersections():
     with get_conn() as conn:
         with conn.cursor() as cur:
             if not tables:
-                cur.execute("""
-                    SELECT f_table_name
-                    FROM public.geometry_columns
-                    WHERE f_table_schema='public' AND f_table_name LIKE 'pai_%'
-                    ORDER BY f_table_name
-                """)
-                tables = [r[0] for r in cur.fetchall()]
+                tables = list_pai_tables(cur)
+
+            tables = [safe_ident(t) for t in tables]
+            etag = make_etag(layer_versions(cur, tables), "intersections", geometry, limit, tables)
+            if not_modified(etag):
+                return cacheable(Response(status=304), etag)
 
             fc = {"type": "FeatureCollection", "features": []}
 
             for table in tables:
-                table = safe_ident(table)
                 if not table_exists(cur, table):
                     continue
 
@@ -399,39 +542,38 @@ def intersections():
                 class_col = detect_class_col(cur, table)
                 class_col = safe_ident(class_col) if class_col else None
 
-                if class_col:
+                cls_sql = class_col if class_col else "NULL"
+                display_col = detect_display_col(cur, table)
+                if display_col:
+                    # query di visualizzazione: input e layer entrambi in 4326, nessun ST_Transform
                     sql = f"""
                       SELECT
-                        ST_AsGeoJSON(ST_Transform({geom_col}, 4326), 6) AS g,
-                        {class_col} AS cls
+                        ST_AsGeoJSON({display_col}, 6) AS g,
+                        {cls_sql} AS cls
                       FROM {table}
                       WHERE ST_Intersects(
-                        {geom_col},
-                        ST_Transform(
-                          ST_SetSRID(ST_GeomFromGeoJSON(%s), {INPUT_SRID}),
-                          {DB_SRID}
-                        )
+                        {display_col},
+                        ST_SetSRID(ST_GeomFromGeoJSON($1), {INPUT_SRID})
                       )
-                      LIMIT %s
+                      LIMIT $2
                     """
                 else:
                     sql = f"""
                       SELECT
                         ST_AsGeoJSON(ST_Transform({geom_col}, 4326), 6) AS g,
-                        NULL AS cls
+                        {cls_sql} AS cls
                       FROM {table}
                       WHERE ST_Intersects(
                         {geom_col},
                         ST_Transform(
-                          ST_SetSRID(ST_GeomFromGeoJSON(%s), {INPUT_SRID}),
+                          ST_SetSRID(ST_GeomFromGeoJSON($1), {INPUT_SRID}),
                           {DB_SRID}
                         )
                       )
-                      LIMIT %s
+                      LIMIT $2
                     """
 
-                cur.execute(sql, (geom_json, limit))
-                rows = cur.fetchall()
+                rows = execute_prepared(cur, table, "intersections", sql, [geom_json, limit], ["text", "integer"])
 
                 for g, cls in rows:
                     if not g:
@@ -442,7 +584,413 @@ def intersections():
                         "properties": {"table": table, "class": cls}
                     })
 
-    return jsonify({"ok": True, "fc": fc, "count": len(fc["features"])})
+    return cacheable(jsonify({"ok": True, "fc": fc, "count": len(fc["features"])}), etag)
+
+
+# -------------------------
+# EXPORT (FlatGeobuf / GeoParquet)
+# -------------------------
+
+@app.get("/export/<table>")
+@admitted("export", 2)
+def export_table(table: str):
+    """
+    Scarica un intero layer in EPSG:4326.
+      - format: fgb (default, con indice spaziale per letture HTTP Range) | parquet
+    Il file resta in cache su disco finché i dati del layer non cambiano.
+    """
+    table = safe_ident(table)
+    fmt = check_format(request.args.get("format"))
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if not table_exists(cur, table):
+                return jsonify({"ok": False, "error": "table not found"}), 404
+
+            geom_col = detect_geom_col(cur, table)
+            if not geom_col:
+                return jsonify({"ok": False, "error": "geom column not found"}), 400
+            geom_col = safe_ident(geom_col)
+
+        path = layer_export(conn, table, geom_col, fmt)
+
+    ext, mime = FORMATS[fmt]
+    return send_file(path, mimetype=mime, as_attachment=True, download_name=f"{table}{ext}", conditional=True)
+
+
+@app.post("/intersections/export")
+@admitted("intersections_export", 2)
+def intersections_export():
+    """
+    Come /intersections, ma restituisce un file (fgb | parquet) con tutte le
+    geometrie intersecate: colonne layer, class, geometry.
+      - geometry (GeoJSON geometry)
+      - tables: [..] opzionale, se vuoto usa tutte le pai_*
+      - format: fgb (default) | parquet
+    """
+    payload = request.get_json(silent=True) or {}
+    geometry = payload.get("geometry")
+    if geometry is None:
+        return jsonify({"ok": False, "error": "Missing geometry"}), 400
+
+    geom_json = json.dumps(geometry)
+    fmt = check_format(payload.get("format") or request.args.get("format"))
+    tables = payload.get("tables") or []
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if not tables:
+                tables = list_pai_tables(cur)
+
+            parts = []
+            for table in tables:
+                table = safe_ident(table)
+                if not table_exists(cur, table):
+                    continue
+
+                geom_col = detect_geom_col(cur, table)
+                if not geom_col:
+                    continue
+                geom_col = safe_ident(geom_col)
+
+                class_col = detect_class_col(cur, table)
+                cls_sql = f"{safe_ident(class_col)}::text" if class_col else "NULL::text"
+
+                parts.append(f"""
+                    SELECT '{table}'::text AS layer, {cls_sql} AS class, {geom_col} AS geom
+                    FROM {table}, input
+                    WHERE ST_Intersects({geom_col}, input.g)
+                """)
+
+            if not parts:
+                return jsonify({"ok": False, "error": "no PAI layers"}), 404
+
+            sql = cur.mogrify(f"""
+                WITH input AS (
+                  SELECT ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON(%s), {INPUT_SRID}), {DB_SRID}) AS g
+                )
+                SELECT layer, class, {geom_select("geom", fmt)}
+                FROM ({" UNION ALL ".join(parts)}) hits
+                LIMIT {MAX_QUERY_FEATURES}
+            """, (geom_json,)).decode("utf-8")
+
+        path = query_export(conn, sql, fmt, "intersections")
+
+    ext, mime = FORMATS[fmt]
+    resp = send_file(path, mimetype=mime, as_attachment=True, download_name=f"intersections{ext}")
+    resp.call_on_close(lambda: path.unlink(missing_ok=True))
+    return resp
+
+
+# -------------------------
+# ADVISOR (indici, validità, statistiche dei layer)
+# -------------------------
+
+def advisor_run(tables, apply_fix: bool):
+    out = []
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if not tables:
+                tables = list_pai_tables(cur)
+            layers = []
+            for table in tables:
+                table = safe_ident(table)
+                if not table_exists(cur, table):
+                    continue
+                geom_col = detect_geom_col(cur, table)
+                if geom_col:
+                    layers.append((table, safe_ident(geom_col)))
+
+        for table, geom_col in layers:
+            if apply_fix:
+                out.append(fix(conn, table, geom_col))
+            else:
+                with conn.cursor() as cur:
+                    out.append(audit(cur, table, geom_col))
+    return out
+
+
+@app.get("/advisor")
+@admitted("advisor", 1)
+def advisor():
+    """Audit dei layer pai_* (o ?table=...): indice GiST, geometrie invalide, bloat, ANALYZE, vertici medi."""
+    tables = request.args.getlist("table")
+    report = advisor_run(tables, apply_fix=False)
+    return jsonify({"ok": True, "layers": report, "with_problems": sum(1 for r in report if r["problems"])})
+
+
+# -------------------------
+# STATISTICHE PERICOLOSITÀ (riepiloghi precalcolati)
+# -------------------------
+
+def ensure_stats_table():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            ensure_stats_tables(cur)
+            conn.commit()
+
+ensure_stats_table()
+
+
+def basin_of_table(table: str):
+    m = re.match(r"^pai_([a-z0-9]+)__", table)
+    return m.group(1) if m else None
+
+
+def stats_refresh(tables, force: bool = False):
+    """Ricalcola i riepiloghi dei layer cambiati (o di `tables` / tutti con force)."""
+    out = []
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            all_tables = list_pai_tables(cur)
+            stale, orphans = stale_layers(cur, all_tables)
+            if tables:
+                targets = [safe_ident(t) for t in tables if force or t in stale]
+            else:
+                targets = all_tables if force else stale
+                for t in orphans:
+                    drop_layer(cur, t)
+                conn.commit()
+
+            for table in targets:
+                if not table_exists(cur, table):
+                    continue
+                geom_col = detect_geom_col(cur, table)
+                class_col = detect_class_col(cur, table)
+                if not geom_col or not class_col:
+                    mark_layer(cur, table, "colonna geometria o classe non trovata")
+                    conn.commit()
+                    out.append({"table": table, "error": "colonna geometria o classe non trovata"})
+                    continue
+                try:
+                    cur.execute("SELECT Find_SRID('public', %s, %s)", (table, geom_col))
+                    srid = int(cur.fetchone()[0] or DB_SRID)
+                    out.append(refresh_layer(cur, table, safe_ident(geom_col), safe_ident(class_col),
+                                             basin_of_table(table), pick_studio_from_value, srid))
+                    conn.commit()
+                except psycopg2.Error as e:
+                    # un layer non elaborabile non blocca gli altri: errore registrato e riportato
+                    conn.rollback()
+                    error = (e.pgerror or str(e)).strip()
+                    mark_layer(cur, table, error)
+                    conn.commit()
+                    out.append({"table": table, "error": error})
+    return out
+
+
+@app.get("/stats")
+def stats():
+    """
+    Riepiloghi precalcolati di pericolosità.
+      - group: basin (default) | layer | comune
+      - bacino, studio: filtri opzionali
+      - grid=<metri> (+ bbox, table opzionali): celle della griglia come GeoJSON, per anteprime rapide
+    """
+    group = request.args.get("group", "basin")
+    bacino = request.args.get("bacino")
+    studio = request.args.get("studio")
+    grid = request.args.get("grid")
+    table = request.args.get("table")
+    bbox_vals = None
+    if grid:
+        try:
+            grid = int(grid)
+            if table:
+                table = safe_ident(table)
+            bbox = request.args.get("bbox")
+            if bbox:
+                bbox_vals = [float(x) for x in bbox.split(",")]
+                if len(bbox_vals) != 4:
+                    raise ValueError("bbox deve essere minx,miny,maxx,maxy")
+        except ValueError as e:
+            return jsonify({"ok": False, "error": f"Parametri grid/bbox/table non validi: {e}"}), 400
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            tables = list_pai_tables(cur)
+            versions = layer_versions(cur, tables)
+            stale, _ = stale_layers(cur, tables)
+            cur.execute("SELECT max(refreshed_at), count(*) FROM stats_pai_refresh")
+            state = cur.fetchone()
+            cur.execute("SELECT table_name, error FROM stats_pai_refresh WHERE error IS NOT NULL")
+            errors = dict(cur.fetchall())
+        etag = make_etag(versions, "stats", state, request.args.to_dict(flat=False))
+        if not_modified(etag):
+            return cacheable(Response(status=304), etag)
+
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+
+            where = ["TRUE"]
+            params = []
+            if bacino:
+                where.append("l.bacino = %s")
+                params.append(bacino.lower())
+            if studio:
+                where.append("l.studio = %s")
+                params.append(studio)
+
+            if grid:
+                where.append("g.resolution_m = %s")
+                params.append(grid)
+                if table:
+                    where.append("g.table_name = %s")
+                    params.append(table)
+                if bbox_vals:
+                    where.append("g.geom && ST_MakeEnvelope(%s,%s,%s,%s,4326)")
+                    params.extend(bbox_vals)
+                cur.execute(f"""
+                    SELECT g.table_name, l.bacino, l.studio, g.classe, g.feature_count, g.area_m2,
+                           g.area_m2 / (g.resolution_m::float8 * g.resolution_m) AS coverage,
+                           ST_AsGeoJSON(g.geom, 6) AS geom
+                    FROM stats_pai_grid g
+                    JOIN stats_pai_layer l ON l.table_name = g.table_name AND l.classe = g.classe
+                    WHERE {" AND ".join(where)}
+                    LIMIT 20000
+                """, params)
+                fc = {"type": "FeatureCollection", "features": []}
+                for r in cur.fetchall():
+                    g = r.pop("geom")
+                    fc["features"].append({"type": "Feature", "geometry": json.loads(g), "properties": r})
+                return cacheable(jsonify({"ok": True, "fc": fc, "count": len(fc["features"]), "stale": stale, "errors": errors}), etag)
+
+            if group == "layer":
+                cur.execute(f"""
+                    SELECT l.table_name, l.bacino, l.studio, l.classe, l.feature_count, l.area_m2,
+                           l.bbox4326, l.layer_version, l.refreshed_at
+                    FROM stats_pai_layer l
+                    WHERE {" AND ".join(where)}
+                    ORDER BY l.table_name, l.classe
+                """, params)
+            elif group == "comune":
+                cur.execute(f"""
+                    SELECT l.bacino, l.studio, c.comune, c.classe,
+                           sum(c.feature_count) AS feature_count, sum(c.area_m2) AS area_m2
+                    FROM stats_pai_comune c
+                    JOIN stats_pai_layer l ON l.table_name = c.table_name AND l.classe = c.classe
+                    WHERE {" AND ".join(where)}
+                    GROUP BY l.bacino, l.studio, c.comune, c.classe
+                    ORDER BY l.bacino, c.comune, c.classe
+                """, params)
+            else:
+                cur.execute(f"""
+                    SELECT l.bacino, l.studio, l.classe,
+                           sum(l.feature_count) AS feature_count, sum(l.area_m2) AS area_m2,
+                           ARRAY[min(l.bbox4326[1]), min(l.bbox4326[2]), max(l.bbox4326[3]), max(l.bbox4326[4])] AS bbox4326
+                    FROM stats_pai_layer l
+                    WHERE {" AND ".join(where)}
+                    GROUP BY l.bacino, l.studio, l.classe
+                    ORDER BY l.bacino, l.studio, l.classe
+                """, params)
+            rows = cur.fetchall()
+
+    # layer re-importati dopo l'ultimo refresh: i loro numeri possono essere vecchi
+    return cacheable(jsonify({"ok": True, "group": group, "rows": rows, "stale": stale, "errors": errors}), etag)
+
+
+@app.post("/stats/refresh")
+@admitted("stats_refresh", 1)
+def stats_refresh_endpoint():
+    """Aggiorna i riepiloghi dei layer re-importati (tables: [..] opzionale, force: ricalcola comunque)."""
+    payload = request.get_json(silent=True) or {}
+    refreshed = stats_refresh(payload.get("tables") or [], bool(payload.get("force")))
+    return jsonify({"ok": True, "refreshed": refreshed})
+
+
+# -------------------------
+# CLI
+# -------------------------
+
+@app.cli.command("advisor")
+@click.argument("tables", nargs=-1)
+@click.option("--fix", "apply_fix", is_flag=True, help="Applica le correzioni (indice, ST_MakeValid, CLUSTER, ANALYZE)")
+def advisor_command(tables, apply_fix):
+    """Audit (e con --fix correzione) dei layer indicati, o di tutti i pai_*."""
+    for r in advisor_run(list(tables), apply_fix):
+        problems = ", ".join(r["problems"]) or "ok"
+        click.echo(f"{r['table']}: {problems}")
+        if apply_fix:
+            before = (r["probe_before"] or {}).get("ms")
+            after = (r["probe_after"] or {}).get("ms")
+            click.echo(f"  azioni: {', '.join(r['actions']) or '-'}")
+            click.echo(f"  probe: {before} ms -> {after} ms")
+
+@app.cli.command("layer-version")
+@click.argument("tables", nargs=-1)
+def layer_version_command(tables):
+    """Nuova versione dati per i layer indicati (o tutti i pai_*), da lanciare dopo ogni import."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            ensure_layer_versioning(cur)
+            for table in tables or list_pai_tables(cur):
+                table = safe_ident(table)
+                track_layer(cur, table, bump=True)
+                click.echo(f"{table}: {layer_versions(cur, [table]).get(table)}")
+            conn.commit()
+
+
+@app.cli.command("display-geom")
+@click.argument("tables", nargs=-1)
+@click.option("--simplify-m", default=0.0, help="Tolleranza di semplificazione in metri (0 = nessuna)")
+@click.option("--force", is_flag=True, help="Ricrea la colonna anche se esiste già")
+def display_geom_command(tables, simplify_m, force):
+    """Aggiunge la colonna geom_4326 (display) ai layer indicati, o a tutti i pai_*."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if not tables:
+                cur.execute("""
+                    SELECT f_table_name
+                    FROM public.geometry_columns
+                    WHERE f_table_schema='public' AND f_table_name LIKE 'pai_%%'
+                      AND srid=%s
+                    ORDER BY f_table_name
+                """, (DB_SRID,))
+                tables = [r[0] for r in cur.fetchall()]
+
+            for table in tables:
+                table = safe_ident(table)
+                geom_col = detect_geom_col(cur, table)
+                if not geom_col:
+                    click.echo(f"SKIP: {table} (geom column not found)")
+                    continue
+                done = ensure_display_geom(cur, table, safe_ident(geom_col), simplify_m, force)
+                conn.commit()
+                click.echo(f"{'OK' if done else 'GIA PRESENTE'}: {table}")
+
+
+@app.cli.command("stats-refresh")
+@click.argument("tables", nargs=-1)
+@click.option("--force", is_flag=True, help="Ricalcola anche i layer non cambiati")
+def stats_refresh_command(tables, force):
+    """Aggiorna i riepiloghi di pericolosità dei layer cambiati (o di quelli indicati)."""
+    for r in stats_refresh(list(tables), force):
+        if r.get("error"):
+            click.echo(f"{r['table']}: ERRORE {r['error']}")
+        else:
+            click.echo(f"{r['table']}: {r['classes']} classi (versione {r['version']})")
+
+
+@app.cli.command("projects-import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", default=None, help="geojson | gpkg | csv (default dall'estensione)")
+@click.option("--analyze", is_flag=True, help="Analisi di pericolosità nella stessa transazione")
+@click.option("--srid", default=INPUT_SRID, help="SRID delle geometrie csv/geojson")
+@click.option("--id-col", default=None)
+@click.option("--desc-col", default=None)
+@click.option("--geom-col", default=None, help="Colonna WKT (csv)")
+@click.option("--layer", default=None, help="Layer (gpkg)")
+def projects_import_command(path, fmt, analyze, srid, id_col, desc_col, geom_col, layer):
+    """Import massivo di progetti in saved_projects (COPY + merge)."""
+    fmt = detect_format(path, fmt)
+    report = run_projects_import(path, fmt, analyze, srid, id_col=id_col, desc_col=desc_col,
+                                 geom_col=geom_col, layer=layer)
+    click.echo(f"righe: {report['rows']}  importate: {report['imported']} "
+               f"(nuove {report['inserted']}, aggiornate {report['updated']})  "
+               f"scartate: {report['skipped_missing'] + report['rejected_non_polygonal']}  "
+               f"duplicati: {report['duplicates']}")
+    if report["analysis"]:
+        a = report["analysis"]
+        click.echo(f"analisi: {a['layers']} layer, {a['projects_with_hits']} progetti con pericolosità")
+    click.echo(f"{report['elapsed_s']} s, {report['rows_per_s']} righe/s (COPY {report['copy_rows_per_s']} righe/s)")
 
 
 # -------------------------
@@ -460,11 +1008,46 @@ def ensure_projects_table():
                 updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
               )
             """)
+            ensure_import_tables(cur)
             conn.commit()
 
 ensure_projects_table()
 
 
+def analysis_layers(cur, rules: dict):
+    """[(bacino, tabella, geom_col, class_col)] per l'analisi set-based dell'import, stesse regole di /analyze."""
+    layers = []
+    for bacino, cfg in (rules or {}).items():
+        cfg = cfg or {}
+        for table in discover_tables_for_basin(cur, bacino, cfg):
+            if not table_exists(cur, table):
+                continue
+            geom_col = cfg.get("geom_col") or detect_geom_col(cur, table)
+            class_col = cfg.get("class_col") or detect_class_col(cur, table)
+            if not geom_col or not class_col:
+                continue
+            layers.append((bacino, table, safe_ident(geom_col), safe_ident(class_col)))
+    return layers
+
+
+def run_projects_import(path, fmt: str, analyze: bool, srid: int = INPUT_SRID, **cols):
+    rows = read_projects(path, fmt, **cols)
+    if fmt == "gpkg":
+        srid = INPUT_SRID  # riproiettato da ogr2ogr
+    with get_conn() as conn:
+        layers = None
+        if analyze:
+            with conn.cursor() as cur:
+                layers = analysis_layers(cur, load_rules())
+        report = import_projects(conn, rows, srid=srid, layers=layers, db_srid=DB_SRID)
+        conn.commit()
+
+    if report["analysis"]:
+        for r in report["analysis"]["by_class"]:
+            r["studio"] = pick_studio_from_value(r["pericolosita"])
+    return report
+
+
 @app.get("/projects")
 def list_projects():
     with get_conn() as conn:
@@ -490,12 +1073,22 @@ def get_project(pid: int):
               WHERE project_id=%s
             """, (pid,))
             r = cur.fetchone()
+            cur.execute("""
+              SELECT bacino, table_name, pericolosita, analyzed_at
+              FROM project_hazards
+              WHERE project_id=%s
+              ORDER BY bacino, table_name, pericolosita
+            """, (pid,))
+            hazards = [
+                {"bacino": b, "table": t, "pericolosita": per, "studio": pick_studio_from_value(per), "analyzed_at": at}
+                for b, t, per, at in cur.fetchall()
+            ]
 
     if not r:
         return jsonify({"ok": False, "error": "not found"}), 404
 
     desc, g = r
-    return jsonify({"ok": True, "project_id": pid, "description": desc, "geometry": json.loads(g)})
+    return jsonify({"ok": True, "project_id": pid, "description": desc, "geometry": json.loads(g), "hazards": hazards})
 
 
 @app.post("/projects")
@@ -524,11 +1117,50 @@ def save_project():
                   geom=EXCLUDED.geom,
                   updated_at=NOW()
             """, (int(pid), desc, geom_json))
+            # l'analisi salvata (import massivo) si riferisce alla geometria precedente
+            cur.execute("DELETE FROM project_hazards WHERE project_id=%s", (int(pid),))
             conn.commit()
 
     return jsonify({"ok": True})
 
 
+@app.post("/projects/import")
+@admitted("projects_import", 1)
+def projects_import():
+    """
+    Import massivo di progetti (es. anagrafica asset ENEL) da file multipart `file`:
+      - format: geojson | gpkg | csv (default dall'estensione); csv con geometria WKT
+      - id_col, desc_col, geom_col (csv), layer (gpkg): nomi colonne/layer
+      - srid: SRID delle geometrie csv/geojson (default 4326; gpkg viene riproiettato)
+      - analyze=1: analisi di pericolosità di tutti i progetti nella stessa transazione
+    COPY in staging + un solo merge; risposta con conteggi e righe/s.
+    """
+    upload = request.files.get("file")
+    if upload is None:
+        return jsonify({"ok": False, "error": "Missing file"}), 400
+
+    try:
+        fmt = detect_format(upload.filename, request.form.get("format"))
+        srid = int(request.form.get("srid") or INPUT_SRID)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    analyze = request.form.get("analyze") in ("1", "true", "yes")
+    cols = {k: request.form.get(k) for k in ("id_col", "desc_col", "geom_col", "layer") if request.form.get(k)}
+
+    fd, path = tempfile.mkstemp(suffix=Path(upload.filename or "").suffix)
+    os.close(fd)
+    try:
+        upload.save(path)
+        report = run_projects_import(path, fmt, analyze, srid, **cols)
+    except (ValueError, RuntimeError, psycopg2.DataError, psycopg2.InternalError) as e:
+        # id non numerici, WKT/GeoJSON non validi, colonne mancanti: nessuna riga importata
+        return jsonify({"ok": False, "error": str(e).strip()}), 400
+    finally:
+        os.unlink(path)
+
+    return jsonify({"ok": True, **report})
+
+
 @app.delete("/projects/<int:pid>")
 def delete_project(pid: int):
     with get_conn() as conn:
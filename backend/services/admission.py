@@ -0,0 +1,250 @@
+import os
+import hashlib
+import ipaddress
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import Response, current_app, jsonify, request
+
+WAIT_MS = float(os.getenv("ADMISSION_WAIT_MS", "200"))
+# per client e per endpoint: ben sopra le 4 richieste parallele del feature worker (più caricamenti sovrapposti)
+PER_CLIENT = int(os.getenv("ADMISSION_PER_CLIENT", "16"))
+RETRY_AFTER = os.getenv("ADMISSION_RETRY_AFTER", "2")
+# attesa massima di una richiesta accodata a un'esecuzione identica già in corso
+COALESCE_WAIT_MS = float(os.getenv("COALESCE_WAIT_MS", "10000"))
+# X-Real-IP è considerato solo se la richiesta arriva da qui (nginx nella rete docker)
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(n.strip(), strict=False)
+    for n in os.getenv("ADMISSION_TRUSTED_PROXIES", "127.0.0.1/32,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16").split(",")
+    if n.strip()
+]
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _bump(endpoint: str, key: str):
+    with _stats_lock:
+        s = _stats.setdefault(endpoint, {"leaders": 0, "coalesced": 0, "coalesce_timeouts": 0,
+                                         "admitted": 0, "rejected_429": 0, "rejected_503": 0})
+        s[key] += 1
+
+
+def admission_stats():
+    with _stats_lock:
+        out = {k: dict(v) for k, v in _stats.items()}
+    for name, gate in _gates.items():
+        out.setdefault(name, {})["budget"] = gate.budget
+        out[name]["in_use"] = round(gate.used, 2)
+    return out
+
+
+# -------------------------
+# SINGLE-FLIGHT
+# -------------------------
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _request_key() -> str:
+    h = hashlib.sha1()
+    for part in (request.method, request.path, request.query_string,
+                 request.headers.get("If-None-Match", ""), request.get_data(cache=True)):
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"|")
+    return h.hexdigest()
+
+
+def coalesced(view):
+    """
+    Richieste identiche concorrenti (metodo, path, query, body, If-None-Match)
+    condividono un'unica esecuzione: il primo arrivato calcola, gli altri
+    attendono e ricevono una copia della stessa risposta.
+    Anche chi attende occupa un thread: conta nel limite ADMISSION_PER_CLIENT
+    (429) e oltre COALESCE_WAIT_MS riceve 503 invece di restare appeso.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = _request_key()
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+
+        if not leader:
+            client = ("coalesced", request.endpoint, _client_id())
+            with _clients_lock:
+                if _clients.get(client, 0) >= PER_CLIENT:
+                    _bump(request.endpoint, "rejected_429")
+                    return _overloaded(429, "Troppe richieste in corso per questo client su questo endpoint")
+                _clients[client] = _clients.get(client, 0) + 1
+            try:
+                _bump(request.endpoint, "coalesced")
+                finished = flight.done.wait(COALESCE_WAIT_MS / 1000.0)
+            finally:
+                with _clients_lock:
+                    _clients[client] -= 1
+                    if not _clients[client]:
+                        del _clients[client]
+            if not finished:
+                _bump(request.endpoint, "coalesce_timeouts")
+                return _overloaded(503, "Servizio sovraccarico, riprova")
+            if flight.error is not None:
+                raise flight.error
+            data, status, headers = flight.result
+            return Response(data, status=status, headers=headers)
+
+        _bump(request.endpoint, "leaders")
+        try:
+            resp = current_app.make_response(view(*args, **kwargs))
+            flight.result = (resp.get_data(), resp.status_code,
+                             [(k, v) for k, v in resp.headers.items() if k.lower() != "content-length"])
+            return resp
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with _flights_lock:
+                _flights.pop(key, None)
+            flight.done.set()
+    return wrapper
+
+
+# -------------------------
+# ADMISSION CONTROL
+# -------------------------
+
+class Gate:
+    """Budget di costo in volo per endpoint (con costo 1 equivale a un limite di concorrenza)."""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.used = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self, cost: float, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.used + cost > self.budget:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            self.used += cost
+            return True
+
+    def release(self, cost: float):
+        with self.cond:
+            self.used -= cost
+            self.cond.notify_all()
+
+
+_gates = {}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _trusted_proxy(addr: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(ip in net for net in TRUSTED_PROXIES)
+
+
+def _client_id() -> str:
+    remote = request.remote_addr or "-"
+    if _trusted_proxy(remote):
+        return request.headers.get("X-Real-IP") or remote
+    return remote
+
+
+def _walk_coords(coords, acc):
+    if not isinstance(coords, (list, tuple)) or not coords:
+        return
+    if isinstance(coords[0], (int, float)):
+        acc.append(coords)
+        return
+    for c in coords:
+        _walk_coords(c, acc)
+
+
+def geometry_size(geometry) -> tuple:
+    """(numero vertici, area bbox in km²) di una geometria GeoJSON in 4326."""
+    pts = []
+    if isinstance(geometry, dict):
+        if geometry.get("type") == "FeatureCollection":
+            for f in geometry.get("features") or []:
+                _walk_coords((f.get("geometry") or {}).get("coordinates"), pts)
+        else:
+            _walk_coords(geometry.get("coordinates"), pts)
+    if not pts:
+        return 0, 0.0
+    xs = [p[0] for p in pts]
+    ys = [p[1] for p in pts]
+    lat = math.radians((min(ys) + max(ys)) / 2)
+    area = (max(xs) - min(xs)) * 111.32 * math.cos(lat) * (max(ys) - min(ys)) * 110.57
+    return len(pts), abs(area)
+
+
+def geometry_cost(geometry) -> float:
+    """Costo stimato di una query spaziale: 1 + vertici/500 + km² di bbox/50."""
+    vertices, area_km2 = geometry_size(geometry)
+    return 1.0 + vertices / 500.0 + area_km2 / 50.0
+
+
+def _overloaded(status: int, message: str):
+    resp = jsonify({"ok": False, "error": message})
+    resp.status_code = status
+    resp.headers["Retry-After"] = RETRY_AFTER
+    return resp
+
+
+def admitted(name: str, budget: float, cost=None):
+    """
+    Ammissione per endpoint: `cost()` (default 1) stima il carico della richiesta,
+    limitato al budget così una richiesta grande può comunque girare da sola.
+      - 429 se il client ha già ADMISSION_PER_CLIENT richieste in corso su questo endpoint
+      - 503 se il budget dell'endpoint resta pieno oltre ADMISSION_WAIT_MS
+    """
+    budget = float(os.getenv(f"ADMISSION_BUDGET_{name.upper()}", str(budget)))
+    gate = _gates[name] = Gate(budget)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            client = (name, _client_id())
+            with _clients_lock:
+                if _clients.get(client, 0) >= PER_CLIENT:
+                    _bump(name, "rejected_429")
+                    return _overloaded(429, "Troppe richieste in corso per questo client su questo endpoint")
+                _clients[client] = _clients.get(client, 0) + 1
+
+            try:
+                c = min(float(cost()) if cost else 1.0, gate.budget)
+                if not gate.acquire(c, WAIT_MS / 1000.0):
+                    _bump(name, "rejected_503")
+                    return _overloaded(503, "Servizio sovraccarico, riprova")
+                _bump(name, "admitted")
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    gate.release(c)
+            finally:
+                with _clients_lock:
+                    _clients[client] -= 1
+                    if not _clients[client]:
+                        del _clients[client]
+        return wrapper
+    return decorator
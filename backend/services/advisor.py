@@ -0,0 +1,206 @@
+import json
+import os
+
+from psycopg2.extensions import quote_ident
+
+STALE_STATS_RATIO = float(os.getenv("ADVISOR_STALE_STATS_RATIO", "0.1"))
+BLOAT_RATIO = float(os.getenv("ADVISOR_BLOAT_RATIO", "0.2"))
+PROBE_RUNS = 3
+PROBE_HALF_SIZE_M = 500
+
+# tipo geometria -> dimensione da estrarre dopo ST_MakeValid (ST_CollectionExtract)
+_EXTRACT = {"POINT": 1, "MULTIPOINT": 1, "LINESTRING": 2, "MULTILINESTRING": 2, "POLYGON": 3, "MULTIPOLYGON": 3}
+
+
+def _gist_index(cur, table: str, geom_col: str):
+    cur.execute("""
+        SELECT ic.relname, i.indisclustered
+        FROM pg_index i
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = ic.relam
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND am.amname = 'gist' AND a.attname = %s AND i.indisvalid
+        ORDER BY i.indisclustered DESC
+        LIMIT 1
+    """, (table, geom_col))
+    r = cur.fetchone()
+    return (r[0], bool(r[1])) if r else (None, False)
+
+
+def _invalid_gist_indexes(cur, table: str, geom_col: str):
+    # residui di un CREATE INDEX CONCURRENTLY fallito: IF NOT EXISTS li considererebbe presenti
+    cur.execute("""
+        SELECT ic.relname
+        FROM pg_index i
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = ic.relam
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND am.amname = 'gist' AND a.attname = %s AND NOT i.indisvalid
+    """, (table, geom_col))
+    return [r[0] for r in cur.fetchall()]
+
+
+def _geometry_type(cur, table: str, geom_col: str):
+    cur.execute("""
+        SELECT type FROM public.geometry_columns
+        WHERE f_table_schema='public' AND f_table_name=%s AND f_geometry_column=%s
+    """, (table, geom_col))
+    r = cur.fetchone()
+    return (r[0] or "").upper() if r else ""
+
+
+def _probe_geom(cur, table: str, geom_col: str):
+    # riquadro di 1 km attorno a un punto del layer: stessa forma di una query /analyze tipica
+    cur.execute(f"""
+        SELECT ST_AsEWKT(ST_Expand(ST_PointOnSurface({geom_col}), {PROBE_HALF_SIZE_M}))
+        FROM {table}
+        WHERE {geom_col} IS NOT NULL AND NOT ST_IsEmpty({geom_col})
+        LIMIT 1
+    """)
+    r = cur.fetchone()
+    return r[0] if r else None
+
+
+def probe(cur, table: str, geom_col: str, probe_ewkt: str):
+    """Tempo (ms, migliore di PROBE_RUNS) e nodo di scansione della query di prova."""
+    if not probe_ewkt:
+        return None
+    best, scan = None, None
+    for _ in range(PROBE_RUNS):
+        cur.execute(f"""
+            EXPLAIN (ANALYZE, FORMAT JSON)
+            SELECT count(*) FROM {table}
+            WHERE ST_Intersects({geom_col}, ST_GeomFromEWKT(%s))
+        """, (probe_ewkt,))
+        raw = cur.fetchone()[0]
+        plan = raw if isinstance(raw, list) else json.loads(raw)
+        ms = float(plan[0]["Execution Time"])
+        if best is None or ms < best:
+            best = ms
+            scan = _scan_nodes(plan[0]["Plan"])
+    return {"ms": round(best, 3), "scan": scan}
+
+
+def _scan_nodes(node):
+    out = []
+    if "Scan" in node.get("Node Type", ""):
+        out.append(node["Node Type"])
+    for child in node.get("Plans", []):
+        out.extend(_scan_nodes(child))
+    return out
+
+
+def audit(cur, table: str, geom_col: str) -> dict:
+    index_name, clustered = _gist_index(cur, table, geom_col)
+    invalid_indexes = _invalid_gist_indexes(cur, table, geom_col)
+
+    cur.execute(f"""
+        SELECT count(*),
+               count(*) FILTER (WHERE {geom_col} IS NOT NULL AND NOT ST_IsValid({geom_col})),
+               avg(ST_NPoints({geom_col}))
+        FROM {table}
+    """)
+    rows, invalid, avg_vertices = cur.fetchone()
+
+    cur.execute("""
+        SELECT n_live_tup, n_dead_tup, n_mod_since_analyze,
+               GREATEST(last_analyze, last_autoanalyze),
+               pg_total_relation_size(relid)
+        FROM pg_stat_user_tables
+        WHERE relid = %s::regclass
+    """, (table,))
+    live, dead, mod_since, last_analyze, size = cur.fetchone() or (0, 0, 0, None, 0)
+
+    dead_ratio = (dead / (live + dead)) if (live or dead) else 0.0
+    problems = []
+    if not index_name:
+        problems.append("missing_gist_index")
+    if invalid_indexes:
+        problems.append("invalid_gist_index")
+    if invalid:
+        problems.append("invalid_geometries")
+    if index_name and not clustered:
+        problems.append("not_clustered")
+    if last_analyze is None or (live and mod_since > STALE_STATS_RATIO * live):
+        problems.append("stale_statistics")
+    if dead_ratio > BLOAT_RATIO:
+        problems.append("bloat")
+
+    return {
+        "table": table,
+        "geom_col": geom_col,
+        "rows": int(rows),
+        "gist_index": index_name,
+        "invalid_indexes": invalid_indexes,
+        "clustered": clustered,
+        "invalid_geometries": int(invalid),
+        "avg_vertices": round(float(avg_vertices), 1) if avg_vertices is not None else None,
+        "dead_ratio": round(dead_ratio, 4),
+        "size_bytes": int(size or 0),
+        "last_analyze": last_analyze.isoformat() if last_analyze else None,
+        "mod_since_analyze": int(mod_since or 0),
+        "problems": problems,
+    }
+
+
+def fix(conn, table: str, geom_col: str) -> dict:
+    """
+    Audit + correzioni (CREATE INDEX CONCURRENTLY, ST_MakeValid, CLUSTER sul GiST, ANALYZE)
+    con la stessa query di prova misurata prima e dopo.
+    CREATE INDEX CONCURRENTLY non può girare in transazione: la connessione passa in autocommit.
+    """
+    conn.commit()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            report = audit(cur, table, geom_col)
+            probe_ewkt = _probe_geom(cur, table, geom_col)
+            report["probe_before"] = probe(cur, table, geom_col, probe_ewkt)
+            actions = []
+
+            for invalid in report["invalid_indexes"]:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {quote_ident(invalid, cur)}")
+                actions.append(f"DROP INDEX CONCURRENTLY {invalid} (INVALID)")
+
+            index_name = report["gist_index"]
+            if not index_name:
+                index_name = f"{table}_{geom_col}_gist"[:63]
+                cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table} USING GIST ({geom_col})")
+                actions.append(f"CREATE INDEX CONCURRENTLY {index_name}")
+
+            if report["invalid_geometries"]:
+                gtype = _geometry_type(cur, table, geom_col)
+                dim = _EXTRACT.get(gtype)
+                fixed = f"ST_MakeValid({geom_col})"
+                where = f"NOT ST_IsValid({geom_col})"
+                if dim:
+                    # ST_MakeValid può restituire GeometryCollection: riporto al tipo della colonna
+                    fixed = f"ST_CollectionExtract({fixed}, {dim})"
+                    if gtype.startswith("MULTI"):
+                        fixed = f"ST_Multi({fixed})"
+                    else:
+                        # colonna a tipo singolo: se la riparazione produce più parti (es. poligono
+                        # a farfalla) la riga resta invalida e viene riportata, non troncata
+                        where += f" AND ST_NumGeometries({fixed}) = 1"
+                        fixed = f"ST_GeometryN({fixed}, 1)"
+                cur.execute(f"UPDATE {table} SET {geom_col} = {fixed} WHERE {where}")
+                actions.append(f"ST_MakeValid: {cur.rowcount} geometrie")
+                cur.execute(f"SELECT count(*) FROM {table} WHERE NOT ST_IsValid({geom_col})")
+                report["invalid_skipped"] = int(cur.fetchone()[0])
+                if report["invalid_skipped"]:
+                    actions.append(f"ST_MakeValid: {report['invalid_skipped']} geometrie non riparabili nel tipo {gtype}")
+
+            if not report["clustered"] or "bloat" in report["problems"]:
+                cur.execute(f"CLUSTER {table} USING {index_name}")
+                actions.append(f"CLUSTER USING {index_name}")
+
+            if actions or "stale_statistics" in report["problems"]:
+                cur.execute(f"ANALYZE {table}")
+                actions.append("ANALYZE")
+
+            report["actions"] = actions
+            report["probe_after"] = probe(cur, table, geom_col, probe_ewkt)
+            report["after"] = audit(cur, table, geom_col) if actions else None
+    finally:
+        conn.autocommit = False
+    return report
@@ -1,8 +1,11 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict
 import json
 
-from .db import fetchall, fetchone
+from psycopg2.extras import RealDictCursor
+
+from .db import execute_prepared, fetchall, fetchone, get_conn
+from .display_geom import DISPLAY_GEOM_COL
 from .rules import configured_datasets, pericol_rank_map, template_map, infer_tipo_from_pericol
 from .schema import is_geojson_geometry
 
@@ -13,8 +16,9 @@ def _detect_geom_column(table: str) -> str:
         """SELECT f_geometry_column AS geom_col
              FROM public.geometry_columns
              WHERE f_table_schema='public' AND f_table_name=%s
+               AND f_geometry_column <> %s
              LIMIT 1""",
-        [table],
+        [table, DISPLAY_GEOM_COL],
     )
     if row and row.get("geom_col"):
         return row["geom_col"]
@@ -26,6 +30,8 @@ def _detect_geom_column(table: str) -> str:
         [table],
     )
     for r in rows:
+        if r["column_name"] == DISPLAY_GEOM_COL:
+            continue
         if (r.get("udt_name") or "").lower() == "geometry":
             return r["column_name"]
     raise RuntimeError(f"Cannot detect geometry column for table '{table}'")
@@ -59,15 +65,11 @@ def _table_srid(table: str, geom_col: str) -> int:
     srid = row.get("srid") if row else None
     return int(srid) if srid else 0
 
-def _mk_input_geom_sql(geom_geojson: dict, target_srid: int) -> Tuple[str, List[Any]]:
-    geojson_str = json.dumps(geom_geojson)
+def _mk_input_geom_sql(target_srid: int) -> str:
+    # $1 = GeoJSON in input; gli SRID sono interi e vanno nel testo dello statement preparato
     if target_srid and target_srid != DEFAULT_INPUT_SRID:
-        sql = "ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON(%s), %s), %s)"
-        params = [geojson_str, DEFAULT_INPUT_SRID, target_srid]
-    else:
-        sql = "ST_SetSRID(ST_GeomFromGeoJSON(%s), %s)"
-        params = [geojson_str, DEFAULT_INPUT_SRID]
-    return sql, params
+        return f"ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON($1), {DEFAULT_INPUT_SRID}), {int(target_srid)})"
+    return f"ST_SetSRID(ST_GeomFromGeoJSON($1), {DEFAULT_INPUT_SRID})"
 
 def _rank_key(bacino: str, tipo: str, pericol: str) -> int:
     rank = pericol_rank_map()
@@ -103,6 +105,7 @@ def analyze_geometry(geometry_geojson: dict, project_name: str = "", study_hint:
     candidates = []
     all_matches = []
     warnings = []
+    geojson_str = json.dumps(geometry_geojson)
 
     for ds in datasets:
         bacino = ds.get("bacino")
@@ -113,7 +116,7 @@ def analyze_geometry(geometry_geojson: dict, project_name: str = "", study_hint:
         geom_col = _detect_geom_column(table)
         pericol_col = ds.get("pericol_col") or _detect_pericol_column(table)
         srid = _table_srid(table, geom_col)
-        geom_sql, geom_params = _mk_input_geom_sql(geometry_geojson, srid)
+        geom_sql = _mk_input_geom_sql(srid)
 
         sql = f"""SELECT {pericol_col} AS pericol,
                          ST_Dimension({geom_sql}) AS in_dim,
@@ -129,11 +132,9 @@ def analyze_geometry(geometry_geojson: dict, project_name: str = "", study_hint:
                   FROM {table}
                   WHERE ST_Intersects({geom_col}, {geom_sql})"""
 
-        n_params = sql.count("%s")
-        params = []
-        while len(params) < n_params:
-            params.extend(geom_params)
-        rows = fetchall(sql, params[:n_params])
+        with get_conn() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                rows = execute_prepared(cur, table, "analyze_geometry", sql, [geojson_str], ["text"])
 
         if rows:
             candidates.append({"bacino": bacino, "table": table})
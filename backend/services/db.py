@@ -1,9 +1,38 @@
 import os
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
-def get_conn():
-    return psycopg2.connect(
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(int(os.getenv("DB_POOL_MAX", "10")))
+POOL_WAIT_S = float(os.getenv("DB_POOL_WAIT_MS", "2000")) / 1000.0
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Connessione che ricorda gli statement PREPARE della propria sessione.
+
+    `prepared` mappa (table, kind) -> (nome statement, testo SQL): finché la
+    connessione resta nel pool gli statement restano validi lato server.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+def conn_params():
+    return dict(
         host=os.getenv("DB_HOST", "db"),
         port=int(os.getenv("DB_PORT", "5432")),
         dbname=os.getenv("DB_NAME", "gis"),
@@ -11,14 +40,259 @@ def get_conn():
         password=os.getenv("DB_PASSWORD", "password"),
     )
 
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    int(os.getenv("DB_POOL_MIN", "1")),
+                    int(os.getenv("DB_POOL_MAX", "10")),
+                    connection_factory=PreparedConnection,
+                    **conn_params(),
+                )
+    return _pool
+
+
+@contextmanager
+def get_conn():
+    """Connessione dal pool: commit/rollback come `with psycopg2.connect()`, poi restituita.
+    A pool pieno attende fino a DB_POOL_WAIT_MS, poi PoolError (-> 503)."""
+    pool = get_pool()
+    if not _pool_slots.acquire(timeout=POOL_WAIT_S):
+        raise PoolError("connection pool exhausted")
+    try:
+        conn = pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+
 def fetchone(sql: str, params=None):
     with get_conn() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(sql, params or [])
             return cur.fetchone()
 
+
 def fetchall(sql: str, params=None):
     with get_conn() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(sql, params or [])
             return cur.fetchall()
+
+
+# -------------------------
+# VERSIONE DATI DEI LAYER
+# -------------------------
+
+def ensure_layer_versioning(cur):
+    """Tabella delle versioni + funzione trigger: ogni scrittura su un layer tracciato
+    gli assegna un nuovo valore della sequenza (mai riusato, transazionale).
+    Processi avviati insieme (worker, comandi CLI) si serializzano su un advisory
+    lock fino al commit: DDL concorrente fallirebbe con "tuple concurrently updated"."""
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('layer_data_versions'))")
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS layer_data_version_seq")
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS layer_data_versions (
+        table_name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL,
+        updated_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
+      )
+    """)
+    cur.execute("""
+      CREATE OR REPLACE FUNCTION bump_layer_data_version() RETURNS trigger AS $$
+      BEGIN
+        INSERT INTO layer_data_versions (table_name, version, updated_at)
+        VALUES (TG_TABLE_NAME, nextval('layer_data_version_seq'), NOW())
+        ON CONFLICT (table_name) DO UPDATE
+        SET version = EXCLUDED.version, updated_at = NOW();
+        RETURN NULL;
+      END
+      $$ LANGUAGE plpgsql
+    """)
+
+
+def track_layer(cur, table: str, bump: bool = False) -> bool:
+    """
+    Installa il trigger di versione sul layer se manca. Una tabella senza trigger
+    è nuova (o ricreata da ogr2ogr -overwrite) e riceve subito una nuova versione;
+    con bump la versione avanza comunque (es. a fine import).
+    """
+    cur.execute("""
+        SELECT EXISTS (
+          SELECT 1 FROM pg_trigger
+          WHERE tgrelid = %s::regclass AND tgname = 'layer_data_version'
+        )
+    """, (table,))
+    installed = cur.fetchone()[0]
+    if not installed:
+        cur.execute(f"""
+            CREATE OR REPLACE TRIGGER layer_data_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_layer_data_version()
+        """)
+    if bump or not installed:
+        cur.execute("""
+            INSERT INTO layer_data_versions (table_name, version, updated_at)
+            VALUES (%s, nextval('layer_data_version_seq'), NOW())
+            ON CONFLICT (table_name) DO UPDATE
+            SET version = EXCLUDED.version, updated_at = NOW()
+        """, (table,))
+    return not installed
+
+
+def layer_versions(cur, tables):
+    """Versione dati per tabella: OID (cambia a ogni re-import ogr2ogr -overwrite),
+    numero colonne (es. colonna display aggiunta) + versione da layer_data_versions."""
+    if not tables:
+        return {}
+    cur.execute("""
+        SELECT c.relname,
+               c.oid::bigint,
+               c.relnatts,
+               COALESCE(v.version, 0)
+        FROM pg_class c
+        LEFT JOIN layer_data_versions v ON v.table_name = c.relname
+        WHERE c.relnamespace = 'public'::regnamespace
+          AND c.relname = ANY(%s)
+    """, (list(tables),))
+    return {name: f"{oid}.{natts}.{version}" for name, oid, natts, version in cur.fetchall()}
+
+
+# -------------------------
+# PREPARED STATEMENTS
+# -------------------------
+
+def _record(kind: str, what: str, ms: float):
+    with _stats_lock:
+        # PREPARE fa solo parse/analisi: la pianificazione avviene a EXECUTE (vedi "planning")
+        s = _stats.setdefault(kind, {"prepare": 0, "parse_ms": 0.0, "execute": 0, "execute_ms": 0.0, "reprepare": 0})
+        s[what] += 1
+        ms_key = "parse_ms" if what == "prepare" else what + "_ms"
+        if ms_key in s:
+            s[ms_key] += ms
+
+
+def _statement_name(table: str, kind: str) -> str:
+    h = hashlib.sha1(f"{table}:{kind}".encode("utf-8")).hexdigest()[:16]
+    return f"ps_{kind}_{h}"
+
+
+def _prepare(cur, key, name: str, sql: str, types):
+    conn = cur.connection
+    if key in conn.prepared:
+        cur.execute(f"DEALLOCATE {name}")
+        del conn.prepared[key]
+        _record(key[1], "reprepare", 0.0)
+
+    t0 = time.perf_counter()
+    cur.execute(f"PREPARE {name} ({', '.join(types)}) AS {sql}")
+    _record(key[1], "prepare", (time.perf_counter() - t0) * 1000.0)
+    conn.prepared[key] = (name, sql)
+
+
+def execute_prepared(cur, table: str, kind: str, sql: str, params, types):
+    """Esegue `sql` (placeholder $1..$n) come statement preparato della sessione.
+
+    Lo statement è indicizzato per (table, kind) e riusato finché il testo SQL
+    non cambia; se il layer è stato re-importato con uno schema diverso lo
+    statement viene rigenerato una volta sola.
+    """
+    conn = cur.connection
+    key = (table, kind)
+    name = _statement_name(table, kind)
+    cached = conn.prepared.get(key)
+    if cached is None or cached[1] != sql:
+        _prepare(cur, key, name, sql, types)
+
+    placeholders = ", ".join(["%s"] * len(params))
+    execute_sql = f"EXECUTE {name} ({placeholders})" if params else f"EXECUTE {name}"
+    t0 = time.perf_counter()
+    try:
+        # savepoint nello stesso round trip: in caso di errore si annulla solo questo EXECUTE,
+        # non il lavoro precedente nella transazione del chiamante
+        cur.execute(f"SAVEPOINT ps_execute; {execute_sql}", tuple(params))
+    except psycopg2.errors.FeatureNotSupported:
+        # "cached plan must not change result type": tabella ricreata da ogr2ogr -overwrite
+        cur.execute("ROLLBACK TO SAVEPOINT ps_execute")
+        _prepare(cur, key, name, sql, types)
+        cur.execute(execute_sql, tuple(params))
+    rows = cur.fetchall() if cur.description else None
+    cur.execute("RELEASE SAVEPOINT ps_execute")
+    _record(kind, "execute", (time.perf_counter() - t0) * 1000.0)
+    return rows
+
+
+def _planning_stats(cur):
+    """
+    Tempo di pianificazione reale per tipo di query da pg_stat_statements
+    (richiede shared_preload_libraries=pg_stat_statements e track_planning=on).
+    Per gli statement preparati la query registrata è il testo del PREPARE;
+    `plans` < `calls` indica piani generici riusati senza ripianificare.
+    """
+    cur.execute("SELECT to_regclass('pg_stat_statements') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute("SAVEPOINT planning_stats")
+    try:
+        cur.execute("""
+            SELECT substring(query FROM '^PREPARE ps_(.+)_[0-9a-f]{16}'),
+                   sum(calls), sum(plans), sum(total_plan_time), sum(total_exec_time)
+            FROM pg_stat_statements
+            WHERE query LIKE 'PREPARE ps\\_%'
+            GROUP BY 1
+        """)
+        rows = cur.fetchall()
+    except psycopg2.Error:
+        # estensione creata ma libreria non precaricata
+        cur.execute("ROLLBACK TO SAVEPOINT planning_stats")
+        return None
+    cur.execute("RELEASE SAVEPOINT planning_stats")
+
+    out = {}
+    for kind, calls, plans, plan_ms, exec_ms in rows:
+        calls, plans = int(calls or 0), int(plans or 0)
+        out[kind] = {
+            "calls": calls,
+            "plans": plans,
+            "plan_ms": round(float(plan_ms or 0), 3),
+            "avg_plan_ms": round(float(plan_ms) / plans, 3) if plans else None,
+            "plan_ms_per_call": round(float(plan_ms or 0) / calls, 4) if calls else None,
+            "avg_exec_ms": round(float(exec_ms) / calls, 3) if calls else None,
+        }
+    return out
+
+
+def prepared_stats(cur=None):
+    """
+    Contatori per tipo di query (`parse_ms` = PREPARE, cioè parse/analisi; il piano si fa a EXECUTE).
+    Con `cur` aggiunge i piani generic/custom della sessione (PG >= 14) e il tempo di
+    pianificazione da pg_stat_statements, se disponibile.
+    """
+    with _stats_lock:
+        out = {k: dict(v) for k, v in _stats.items()}
+
+    for s in out.values():
+        s["avg_parse_ms"] = round(s["parse_ms"] / s["prepare"], 3) if s["prepare"] else None
+        s["avg_execute_ms"] = round(s["execute_ms"] / s["execute"], 3) if s["execute"] else None
+        s["reuse_ratio"] = round(1 - s["prepare"] / s["execute"], 4) if s["execute"] else None
+
+    session = None
+    planning = None
+    if cur is not None:
+        cur.execute("""
+            SELECT count(*), COALESCE(sum(generic_plans), 0), COALESCE(sum(custom_plans), 0)
+            FROM pg_prepared_statements
+            WHERE name LIKE 'ps\\_%'
+        """)
+        n, generic, custom = cur.fetchone()
+        session = {"statements": int(n), "generic_plans": int(generic), "custom_plans": int(custom)}
+        planning = _planning_stats(cur)
+
+    return {"kinds": out, "session": session, "planning": planning}
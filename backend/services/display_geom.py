@@ -0,0 +1,43 @@
+import os
+
+DISPLAY_GEOM_COL = os.getenv("DISPLAY_GEOM_COL", "geom_4326")
+DISPLAY_SRID = 4326
+
+
+def detect_display_col(cur, table: str):
+    """Colonna geometria di visualizzazione (EPSG:4326) se il layer è stato importato con l'opzione display."""
+    cur.execute("""
+        SELECT 1
+        FROM public.geometry_columns
+        WHERE f_table_schema='public' AND f_table_name=%s
+          AND f_geometry_column=%s AND srid=%s
+    """, (table, DISPLAY_GEOM_COL, DISPLAY_SRID))
+    return DISPLAY_GEOM_COL if cur.fetchone() else None
+
+
+def ensure_display_geom(cur, table: str, geom_col: str, simplify_m: float = 0.0, force: bool = False) -> bool:
+    """
+    Aggiunge a `table` una colonna generata `geom_4326` = ST_Transform(geom, 4326),
+    opzionalmente semplificata (tolleranza in metri, nello SRID del layer) e con indice GiST proprio.
+    Essendo GENERATED ... STORED, PostgreSQL la mantiene allineata a ogni INSERT/UPDATE.
+    La geometria di analisi (`geom_col`) non viene toccata.
+    Ritorna False se la colonna c'era già e `force` è falso.
+    """
+    exists = detect_display_col(cur, table) is not None
+    if exists and not force:
+        return False
+    if exists:
+        cur.execute(f"ALTER TABLE {table} DROP COLUMN {DISPLAY_GEOM_COL}")
+
+    src = geom_col
+    if simplify_m and simplify_m > 0:
+        src = f"ST_SimplifyPreserveTopology({geom_col}, {float(simplify_m)})"
+
+    cur.execute(f"""
+        ALTER TABLE {table}
+        ADD COLUMN {DISPLAY_GEOM_COL} geometry(Geometry, {DISPLAY_SRID})
+        GENERATED ALWAYS AS (ST_Transform({src}, {DISPLAY_SRID})) STORED
+    """)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_{DISPLAY_GEOM_COL}_gist ON {table} USING GIST ({DISPLAY_GEOM_COL})")
+    cur.execute(f"ANALYZE {table}")
+    return True
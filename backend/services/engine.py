@@ -0,0 +1,273 @@
+import os
+import json
+import fcntl
+import hashlib
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from .db import get_conn, layer_versions
+
+try:
+    import numpy as np
+    import shapely
+    from shapely.geometry import shape
+except ImportError:  # motore opzionale: senza shapely /analyze usa solo PostGIS
+    np = None
+    shapely = None
+
+ENGINE_ENABLED = os.getenv("ENGINE_ENABLED", "0") == "1"
+ENGINE_DIR = Path(os.getenv("ENGINE_DIR", "/tmp/pai_engine"))
+ENGINE_CHECK_SECONDS = float(os.getenv("ENGINE_CHECK_SECONDS", "30"))
+ENGINE_MAX_LINE_DEG = float(os.getenv("ENGINE_MAX_LINE_DEG", "0.01"))  # ~1 km
+ENGINE_PREPARED_CACHE = int(os.getenv("ENGINE_PREPARED_CACHE", "4096"))
+BATCH_ROWS = 5000
+
+ELIGIBLE_TYPES = {"Point", "MultiPoint", "LineString", "MultiLineString"}
+
+
+class Snapshot:
+    """
+    Snapshot su disco di tutti i layer pai_* (EPSG:4326):
+      bounds.npy      float64 (N, 4)   bbox per feature
+      table_idx.npy   int32   (N,)     indice in meta["tables"]
+      class_idx.npy   int32   (N,)     indice in meta["classes"] (-1 = NULL)
+      wkb_offsets.npy int64   (N + 1,) offset in wkb.bin
+      wkb.bin                          WKB concatenati
+    Gli array sono aperti in mmap: più processi worker condividono le stesse
+    pagine dalla page cache. Ogni processo costruisce solo il proprio STR-tree
+    sulle bbox e prepara le geometrie che servono (cache LRU).
+    """
+
+    def __init__(self, path: Path, key: str):
+        self.path = path
+        self.key = key
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.tables = self.meta["tables"]
+        self.classes = self.meta["classes"]
+
+        self.bounds = np.load(path / "bounds.npy", mmap_mode="r")
+        self.table_idx = np.load(path / "table_idx.npy", mmap_mode="r")
+        self.class_idx = np.load(path / "class_idx.npy", mmap_mode="r")
+        self.offsets = np.load(path / "wkb_offsets.npy", mmap_mode="r")
+        size = (path / "wkb.bin").stat().st_size
+        self.wkb = np.memmap(path / "wkb.bin", dtype=np.uint8, mode="r") if size else None
+
+        b = self.bounds
+        self.tree = shapely.STRtree(shapely.box(b[:, 0], b[:, 1], b[:, 2], b[:, 3])) if len(b) else None
+        self._prepared = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _geom(self, i: int):
+        with self._lock:
+            g = self._prepared.get(i)
+            if g is not None:
+                self._prepared.move_to_end(i)
+                return g
+        g = shapely.from_wkb(bytes(self.wkb[self.offsets[i]:self.offsets[i + 1]]))
+        shapely.prepare(g)
+        with self._lock:
+            self._prepared[i] = g
+            while len(self._prepared) > ENGINE_PREPARED_CACHE:
+                self._prepared.popitem(last=False)
+        return g
+
+    def query(self, geom) -> dict:
+        """{table: [classi distinte]} dei poligoni intersecati da `geom` (4326)."""
+        out = {}
+        if self.tree is None:
+            return out
+        for i in self.tree.query(geom):
+            i = int(i)
+            if not self._geom(i).intersects(geom):
+                continue
+            c = int(self.class_idx[i])
+            if c < 0:
+                continue
+            classes = out.setdefault(self.tables[int(self.table_idx[i])], [])
+            value = self.classes[c]
+            if value not in classes:
+                classes.append(value)
+        return out
+
+
+def _build(conn, layers, versions: dict, path: Path):
+    tmp = path.parent / f".build-{uuid.uuid4().hex}"
+    tmp.mkdir(parents=True)
+    tables, classes, class_ids = [], [], {}
+    bounds, table_idx, class_idx, offsets = [], [], [], [0]
+
+    try:
+        with open(tmp / "wkb.bin", "wb") as wkb:
+            for table, geom_sql, class_col in layers:
+                t = len(tables)
+                tables.append(table)
+                with conn.cursor(name=f"engine_{uuid.uuid4().hex}") as cur:
+                    cur.itersize = BATCH_ROWS
+                    cur.execute(f"""
+                        SELECT cls, ST_AsBinary(g), ST_XMin(g), ST_YMin(g), ST_XMax(g), ST_YMax(g)
+                        FROM (SELECT {class_col} AS cls, {geom_sql} AS g FROM {table}) s
+                        WHERE g IS NOT NULL
+                    """)
+                    for cls, g, x0, y0, x1, y1 in cur:
+                        if cls is None:
+                            c = -1
+                        else:
+                            c = class_ids.get(cls)
+                            if c is None:
+                                c = class_ids[cls] = len(classes)
+                                classes.append(cls)
+                        wkb.write(bytes(g))
+                        offsets.append(offsets[-1] + len(g))
+                        bounds.append((x0, y0, x1, y1))
+                        table_idx.append(t)
+                        class_idx.append(c)
+
+        np.save(tmp / "bounds.npy", np.asarray(bounds, dtype=np.float64).reshape(-1, 4))
+        np.save(tmp / "table_idx.npy", np.asarray(table_idx, dtype=np.int32))
+        np.save(tmp / "class_idx.npy", np.asarray(class_idx, dtype=np.int32))
+        np.save(tmp / "wkb_offsets.npy", np.asarray(offsets, dtype=np.int64))
+        with open(tmp / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"tables": tables, "classes": classes, "versions": versions, "count": len(table_idx)}, f, default=str)
+
+        os.rename(tmp, path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # snapshot precedenti: chiamato sotto lock esclusivo, quindi nessun processo li sta aprendo;
+    # chi li ha già in mmap continua a leggerli fino al reload
+    for old in ENGINE_DIR.iterdir():
+        if old.is_dir() and old != path and not old.name.startswith("."):
+            shutil.rmtree(old, ignore_errors=True)
+
+
+class HazardEngine:
+    """
+    Motore in memoria per "che pericolosità c'è qui?" su punti e linee corte.
+    `list_tables(cur)` elenca i layer; `describe_layer(cur, table)` restituisce
+    (espressione geometria 4326, colonna classe) o None. Lo snapshot viene
+    ricostruito (una volta, sotto lock su file) quando cambia la versione dati
+    di un layer; la verifica è fatta al massimo ogni ENGINE_CHECK_SECONDS.
+    Build e caricamento avvengono in un thread in background con una propria
+    connessione: finché lo snapshot non è allineato alle versioni correnti le
+    richieste passano da PostGIS, e il nuovo snapshot sostituisce il vecchio
+    sotto lock solo quando è pronto.
+    """
+
+    def __init__(self, list_tables, describe_layer):
+        self.list_tables = list_tables
+        self.describe_layer = describe_layer
+        self._snap = None
+        self._want = None  # chiave delle versioni dati correnti
+        self._builder = None
+        self._error = None
+        self._checked = float("-inf")
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"queries": 0, "fallbacks": 0, "stale": 0, "reloads": 0, "builds": 0,
+                       "build_errors": 0, "query_ms": 0.0}
+
+    def _bump(self, key: str, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    @staticmethod
+    def available() -> bool:
+        return ENGINE_ENABLED and shapely is not None
+
+    def _check(self, conn):
+        """Confronta le versioni dati; se lo snapshot non è aggiornato avvia la build in background."""
+        with conn.cursor() as cur:
+            tables = self.list_tables(cur)
+            versions = layer_versions(cur, tables)
+        key = hashlib.sha1(json.dumps(versions, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+        self._want = key
+        if self._snap is not None and self._snap.key == key:
+            return
+        if self._builder is not None and self._builder.is_alive():
+            return  # al termine, se le versioni sono cambiate ancora, riparte al prossimo controllo
+        self._builder = threading.Thread(target=self._load, args=(tables, versions, key),
+                                         name="engine-build", daemon=True)
+        self._builder.start()
+
+    def _load(self, tables, versions: dict, key: str):
+        try:
+            with get_conn() as conn:
+                snap = self._open(conn, tables, versions, key)
+        except Exception as e:
+            self._bump("build_errors")
+            self._error = f"{type(e).__name__}: {e}"
+            return
+        with self._lock:
+            self._snap = snap
+            self._error = None
+        self._bump("reloads")
+
+    def _open(self, conn, tables, versions: dict, key: str) -> Snapshot:
+        path = ENGINE_DIR / key
+        ENGINE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(ENGINE_DIR / ".lock", "a") as lock:
+            # apertura sotto lock condiviso: la build (esclusiva) non può rimuovere lo snapshot nel frattempo
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if not path.exists():
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not path.exists():  # un altro processo potrebbe averlo appena costruito
+                    layers = []
+                    with conn.cursor() as cur:
+                        for t in tables:
+                            d = self.describe_layer(cur, t)
+                            if d:
+                                layers.append((t, d[0], d[1]))
+                    _build(conn, layers, versions, path)
+                    self._bump("builds")
+            return Snapshot(path, key)
+
+    def snapshot(self, conn):
+        """Snapshot allineato alle versioni dati correnti, o None se è ancora in costruzione."""
+        now = time.monotonic()
+        # una sola richiesta per volta fa il controllo (breve); le altre usano lo stato attuale
+        if now - self._checked > ENGINE_CHECK_SECONDS and self._lock.acquire(blocking=False):
+            try:
+                if now - self._checked > ENGINE_CHECK_SECONDS:
+                    self._check(conn)
+                    self._checked = now
+            finally:
+                self._lock.release()
+        snap = self._snap
+        return snap if snap is not None and snap.key == self._want else None
+
+    def query(self, conn, geometry: dict):
+        """{table: [classi]} se la geometria è un punto/linea corta, altrimenti None (-> PostGIS)."""
+        if not self.available() or not isinstance(geometry, dict) or geometry.get("type") not in ELIGIBLE_TYPES:
+            return None
+        geom = shape(geometry)
+        x0, y0, x1, y1 = geom.bounds
+        if max(x1 - x0, y1 - y0) > ENGINE_MAX_LINE_DEG:
+            self._bump("fallbacks")
+            return None
+
+        snap = self.snapshot(conn)
+        if snap is None:
+            self._bump("stale")
+            return None
+        t0 = time.perf_counter()
+        out = snap.query(geom)
+        with self._stats_lock:
+            self._stats["queries"] += 1
+            self._stats["query_ms"] += (time.perf_counter() - t0) * 1000.0
+        return out
+
+    def stats(self):
+        with self._stats_lock:
+            s = dict(self._stats)
+        s["enabled"] = self.available()
+        s["building"] = self._builder is not None and self._builder.is_alive()
+        s["last_error"] = self._error
+        s["avg_query_ms"] = round(s["query_ms"] / s["queries"], 4) if s["queries"] else None
+        if self._snap is not None:
+            s["snapshot"] = {"key": self._snap.key, "features": self._snap.meta["count"], "tables": len(self._snap.tables)}
+        return s
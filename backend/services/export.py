@@ -0,0 +1,217 @@
+import os
+import fcntl
+import json
+import subprocess
+import threading
+import uuid
+from pathlib import Path
+
+from psycopg2.extensions import quote_ident
+
+from .db import conn_params, layer_versions
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # GeoParquet opzionale
+    pa = None
+    pq = None
+
+EXPORT_DIR = Path(os.getenv("EXPORT_CACHE_DIR", "/tmp/pai_exports"))
+BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "5000"))
+MAX_QUERY_FEATURES = int(os.getenv("EXPORT_MAX_QUERY_FEATURES", "200000"))
+
+FORMATS = {
+    "fgb": (".fgb", "application/vnd.flatgeobuf"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+_lock = threading.Lock()
+_stats = {"layer_hits": 0, "layer_builds": 0, "query_builds": 0}
+
+
+def _bump(key: str):
+    with _lock:
+        _stats[key] += 1
+
+
+def export_stats():
+    with _lock:
+        return dict(_stats)
+
+
+def check_format(fmt: str) -> str:
+    fmt = (fmt or "fgb").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Formato non supportato: {fmt} (usa: {', '.join(FORMATS)})")
+    if fmt == "parquet" and pa is None:
+        raise RuntimeError("Export GeoParquet non disponibile: installa pyarrow")
+    return fmt
+
+
+def geom_select(expr: str, fmt: str) -> str:
+    """Colonna geometria in output (EPSG:4326): geometria nativa per ogr2ogr, WKB per GeoParquet."""
+    g = f"ST_Transform({expr}, 4326)"
+    if fmt == "parquet":
+        return f"ST_AsBinary({g}) AS geometry"
+    return f"{g} AS geometry"
+
+
+def _ogr_pg_conn():
+    """Stringa PG: senza password (visibile in `ps`) + ambiente con PGPASSWORD per libpq."""
+    params = conn_params()
+    env = dict(os.environ, PGPASSWORD=str(params.pop("password")))
+    return "PG:" + " ".join(f"{k}={v}" for k, v in params.items()), env
+
+
+def _write_fgb(sql: str, out: Path, layer_name: str):
+    # ogr2ogr legge da PostGIS con cursore e scrive FlatGeobuf con indice Hilbert R-tree impacchettato.
+    # La query passa da file (-sql @file): con la geometria in input può superare il limite
+    # di 128 KB per singolo argomento della riga di comando.
+    pg_conn, env = _ogr_pg_conn()
+    sql_file = out.with_name(out.name + ".sql")
+    sql_file.write_text(sql, encoding="utf-8")
+    try:
+        cmd = [
+            "ogr2ogr", "-f", "FlatGeobuf", str(out), pg_conn,
+            "-sql", f"@{sql_file}",
+            "-nln", layer_name,
+            "-nlt", "PROMOTE_TO_MULTI",
+            "-lco", "SPATIAL_INDEX=YES",
+        ]
+        r = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    finally:
+        sql_file.unlink(missing_ok=True)
+    if r.returncode != 0:
+        raise RuntimeError(f"ogr2ogr FlatGeobuf fallito: {r.stderr.strip()}")
+
+
+def _arrow_type(type_code: int):
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int32(),
+        23: pa.int32(),
+        700: pa.float64(),
+        701: pa.float64(),
+        1082: pa.date32(),
+        1114: pa.timestamp("us"),
+        1184: pa.timestamp("us", tz="UTC"),
+        17: pa.binary(),
+    }.get(type_code, pa.string())
+
+
+def _arrow_schema(description):
+    fields = [pa.field(d.name, _arrow_type(d.type_code)) for d in description]
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}},
+    }
+    return pa.schema(fields, metadata={b"geo": json.dumps(geo).encode("utf-8")})
+
+
+def _to_array(values, typ):
+    if typ == pa.string():
+        values = [None if v is None else str(v) for v in values]
+    elif typ == pa.binary():
+        values = [None if v is None else bytes(v) for v in values]
+    return pa.array(values, type=typ)
+
+
+def _write_parquet(conn, sql: str, out: Path):
+    # cursore lato server: in memoria al massimo BATCH_ROWS righe (un row group)
+    writer = None
+    with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cur:
+        cur.itersize = BATCH_ROWS
+        cur.execute(sql)
+        try:
+            while True:
+                rows = cur.fetchmany(BATCH_ROWS)
+                if writer is None:
+                    schema = _arrow_schema(cur.description)
+                    writer = pq.ParquetWriter(str(out), schema)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                arrays = [_to_array(col, f.type) for col, f in zip(columns, schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+def write_export(conn, sql: str, fmt: str, out: Path, layer_name: str):
+    if fmt == "fgb":
+        _write_fgb(sql, out, layer_name)
+    else:
+        _write_parquet(conn, sql, out)
+
+
+def _layer_attrs(cur, table: str):
+    cur.execute("""
+        SELECT column_name, udt_name
+        FROM information_schema.columns
+        WHERE table_schema='public' AND table_name=%s
+        ORDER BY ordinal_position
+    """, (table,))
+    attrs = []
+    for name, udt in cur.fetchall():
+        if udt == "geometry":
+            continue
+        q = quote_ident(name, cur)
+        attrs.append(f"{q}::float8 AS {q}" if udt == "numeric" else q)
+    return attrs
+
+
+def layer_export(conn, table: str, geom_col: str, fmt: str) -> Path:
+    """File di export del layer, riusato su disco finché la versione dati del layer non cambia."""
+    ext, _mime = FORMATS[fmt]
+    with conn.cursor() as cur:
+        version = layer_versions(cur, [table]).get(table)
+        attrs = _layer_attrs(cur, table)
+
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    path = EXPORT_DIR / f"{table}.{version}{ext}"
+    if path.exists():
+        _bump("layer_hits")
+        return path
+
+    cols = attrs + [geom_select(geom_col, fmt)]
+    sql = f"SELECT {', '.join(cols)} FROM {table} WHERE {geom_col} IS NOT NULL"
+
+    # un solo build per layer e formato tra tutti i processi: gli altri attendono e riusano il file
+    with open(EXPORT_DIR / f".{table}{ext}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if path.exists():
+            _bump("layer_hits")
+            return path
+
+        # il nome deve finire con l'estensione: senza .fgb il driver FlatGeobuf crea una directory
+        tmp = EXPORT_DIR / f"{table}.{uuid.uuid4().hex}.tmp{ext}"
+        try:
+            write_export(conn, sql, fmt, tmp, table)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        _bump("layer_builds")
+
+        # versioni precedenti dello stesso layer non servono più
+        for old in EXPORT_DIR.glob(f"{table}.*{ext}"):
+            if old != path:
+                old.unlink(missing_ok=True)
+    return path
+
+
+def query_export(conn, sql: str, fmt: str, layer_name: str) -> Path:
+    """File temporaneo per un risultato non cacheabile (es. intersezioni): il chiamante lo rimuove."""
+    ext, _mime = FORMATS[fmt]
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    path = EXPORT_DIR / f"query.{uuid.uuid4().hex}.tmp{ext}"
+    try:
+        write_export(conn, sql, fmt, path, layer_name)
+    except Exception:
+        path.unlink(missing_ok=True)
+        raise
+    _bump("query_builds")
+    return path
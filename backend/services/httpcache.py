@@ -0,0 +1,98 @@
+import os
+import gzip
+import hashlib
+import json
+import threading
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # opzionale: senza brotli si negozia solo gzip
+    brotli = None
+
+MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "60"))
+COMPRESS_MIN_BYTES = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_TYPES = ("application/json", "application/geo+json")
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _bump(endpoint: str, key: str, n: int = 1):
+    with _lock:
+        s = _stats.setdefault(endpoint, {"requests": 0, "conditional": 0, "not_modified": 0,
+                                         "bytes_raw": 0, "bytes_sent": 0})
+        s[key] += n
+
+
+def make_etag(versions: dict, *parts) -> str:
+    """ETag da versioni dei layer coinvolti + parametri della query."""
+    h = hashlib.sha1()
+    h.update(json.dumps(versions, sort_keys=True, default=str).encode("utf-8"))
+    for p in parts:
+        h.update(b"|")
+        h.update(json.dumps(p, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()[:32]
+
+
+def not_modified(etag: str):
+    """True se il client ha già questa versione (If-None-Match): la view risponde 304 senza interrogare i layer."""
+    endpoint = request.endpoint or request.path
+    _bump(endpoint, "requests")
+    if request.if_none_match:
+        _bump(endpoint, "conditional")
+        if request.if_none_match.contains_weak(etag):
+            _bump(endpoint, "not_modified")
+            return True
+    return False
+
+
+def cacheable(resp, etag: str, max_age: int = None):
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = f"public, max-age={MAX_AGE if max_age is None else max_age}"
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+def _choose_encoding():
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def compress(resp):
+    """after_request: comprime le risposte JSON (br/gzip) secondo Accept-Encoding."""
+    if (resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or "Content-Encoding" in resp.headers
+            or resp.mimetype not in COMPRESS_TYPES):
+        return resp
+
+    data = resp.get_data()
+    resp.vary.add("Accept-Encoding")
+    if len(data) < COMPRESS_MIN_BYTES:
+        return resp
+
+    enc = _choose_encoding()
+    if not enc:
+        return resp
+
+    if enc == "br":
+        body = brotli.compress(data, quality=5)
+    else:
+        body = gzip.compress(data, compresslevel=6)
+
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = enc
+    endpoint = request.endpoint or request.path
+    _bump(endpoint, "bytes_raw", len(data))
+    _bump(endpoint, "bytes_sent", len(body))
+    return resp
+
+
+def cache_stats():
+    with _lock:
+        out = {k: dict(v) for k, v in _stats.items()}
+    for s in out.values():
+        s["hit_ratio"] = round(s["not_modified"] / s["requests"], 4) if s["requests"] else None
+        s["compression_ratio"] = round(s["bytes_sent"] / s["bytes_raw"], 4) if s["bytes_raw"] else None
+    return out
@@ -0,0 +1,279 @@
+import os
+import csv
+import io
+import itertools
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+IMPORT_ID_COL = os.getenv("IMPORT_ID_COL", "project_id")
+IMPORT_DESC_COL = os.getenv("IMPORT_DESC_COL", "description")
+WKT_COLS = ("wkt", "WKT", "geom", "geometry")  # WKT: colonna di ogr2ogr -lco GEOMETRY=AS_WKT
+REJECTED_SAMPLE = 100
+
+FORMATS = {".geojson": "geojson", ".json": "geojson", ".gpkg": "gpkg", ".csv": "csv"}
+
+csv.field_size_limit(sys.maxsize)  # WKT di poligoni grandi superano il limite di default (128 KB)
+
+
+def ensure_import_tables(cur):
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS project_hazards (
+        project_id BIGINT NOT NULL REFERENCES saved_projects(project_id) ON DELETE CASCADE,
+        bacino TEXT NOT NULL,
+        table_name TEXT NOT NULL,
+        pericolosita TEXT NOT NULL,
+        analyzed_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
+        PRIMARY KEY (project_id, table_name, pericolosita)
+      )
+    """)
+
+
+def detect_format(filename: str, fmt: str = None) -> str:
+    fmt = (fmt or FORMATS.get(Path(filename or "").suffix.lower(), "")).lower()
+    if fmt not in set(FORMATS.values()):
+        raise ValueError(f"Formato non supportato: {fmt or filename} (usa: geojson, gpkg, csv)")
+    return fmt
+
+
+# -------------------------
+# LETTURA SORGENTI -> (project_id, description, geometria GeoJSON o WKT)
+# -------------------------
+
+def _geojson_rows(path, id_col, desc_col):
+    # file intero in memoria: migliaia di progetti stanno comodamente in RAM
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    features = (data.get("features") or []) if data.get("type") == "FeatureCollection" else [data]
+    for feat in features:
+        props = feat.get("properties") or {}
+        geometry = feat.get("geometry")
+        yield props.get(id_col, feat.get("id")), props.get(desc_col), json.dumps(geometry) if geometry else None
+
+
+def _csv_rows(fh, id_col, desc_col, geom_col=None):
+    reader = csv.DictReader(fh)
+    fields = reader.fieldnames or []
+    col = geom_col or next((c for c in WKT_COLS if c in fields), None)
+    if col not in fields:
+        raise ValueError(f"Colonna WKT non trovata (colonne: {', '.join(fields)})")
+    if id_col not in fields:
+        raise ValueError(f"Colonna {id_col} non trovata (colonne: {', '.join(fields)})")
+    for r in reader:
+        yield r.get(id_col), r.get(desc_col), r.get(col)
+
+
+def _gpkg_rows(path, id_col, desc_col, layer=None):
+    # ogr2ogr converte in streaming a CSV con WKT già in EPSG:4326
+    cmd = ["ogr2ogr", "-f", "CSV", "/vsistdout/", str(path),
+           "-t_srs", "EPSG:4326", "-lco", "GEOMETRY=AS_WKT"]
+    if layer:
+        cmd.append(layer)
+    # stderr su file: con una pipe non letta, molti warning di ogr2ogr bloccherebbero lo stream
+    with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as errf:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errf, text=True, encoding="utf-8")
+
+        def failed():
+            errf.seek(0)
+            return RuntimeError(f"ogr2ogr fallito: {errf.read().strip()}")
+
+        try:
+            try:
+                yield from _csv_rows(proc.stdout, id_col, desc_col, "WKT")
+            except ValueError:
+                # output vuoto: layer inesistente o file non leggibile, il motivo è su stderr
+                if proc.wait() != 0:
+                    raise failed()
+                raise
+            if proc.wait() != 0:
+                raise failed()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+
+def read_projects(path, fmt: str, id_col: str = None, desc_col: str = None, geom_col: str = None, layer: str = None):
+    """Generatore di (project_id, description, geometria) dal file; per gpkg le geometrie sono già in 4326."""
+    id_col = id_col or IMPORT_ID_COL
+    desc_col = desc_col or IMPORT_DESC_COL
+    if fmt == "geojson":
+        return _geojson_rows(path, id_col, desc_col)
+    if fmt == "gpkg":
+        return _gpkg_rows(path, id_col, desc_col, layer)
+
+    def rows():
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            yield from _csv_rows(f, id_col, desc_col, geom_col)
+    return rows()
+
+
+class _CopyStream:
+    """File-like per COPY FROM STDIN: serializza in CSV le righe del generatore a blocchi."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.count = 0
+        self._buf = ""
+
+    def read(self, size=-1):
+        out = io.StringIO()
+        w = csv.writer(out, lineterminator="\n")
+        while size < 0 or len(self._buf) + out.tell() < size:
+            try:
+                pid, desc, geom = next(self.rows)
+            except StopIteration:
+                break
+            self.count += 1
+            w.writerow((self.count, pid, desc, geom))
+        data = self._buf + out.getvalue()
+        if size < 0:
+            self._buf = ""
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
+
+# -------------------------
+# IMPORT
+# -------------------------
+
+def _analyze(cur, layers, db_srid: int) -> dict:
+    """Tutti i layer in un'unica INSERT ... SELECT (UNION ALL di join spaziali)."""
+    cur.execute(f"""
+        CREATE TEMP TABLE import_projects_db ON COMMIT DROP AS
+        SELECT project_id, ST_Transform(g, {db_srid}) AS g FROM import_projects
+    """)
+    cur.execute("ANALYZE import_projects_db")
+    if not layers:
+        return {"layers": 0, "hits": 0}
+
+    parts, params = [], []
+    for bacino, table, geom_col, class_col in layers:
+        parts.append(f"""
+            SELECT p.project_id, %s, %s, l.{class_col}::text
+            FROM import_projects_db p
+            JOIN {table} l ON ST_Intersects(l.{geom_col}, p.g)
+            WHERE l.{class_col} IS NOT NULL
+        """)
+        params.extend((bacino, table))
+
+    cur.execute(f"""
+        INSERT INTO project_hazards (project_id, bacino, table_name, pericolosita)
+        SELECT DISTINCT * FROM ({" UNION ALL ".join(parts)}) h
+    """, params)
+    return {"layers": len(layers), "hits": cur.rowcount}
+
+
+def import_projects(conn, rows, srid: int = 4326, layers=None, db_srid: int = None) -> dict:
+    """
+    Import massivo in saved_projects, in un'unica transazione:
+      1. COPY in una tabella di staging temporanea (testo grezzo);
+      2. parsing/trasformazione set-based, ultima riga vince per project_id duplicati;
+      3. un solo INSERT ... ON CONFLICT, che azzera le pericolosità salvate dei progetti importati;
+      4. con `layers` [(bacino, tabella, geom_col, class_col)], analisi di pericolosità
+         di tutti i progetti importati in project_hazards.
+    Righe senza id/geometria o non poligonali sono scartate e riportate (campione).
+    """
+    t0 = time.perf_counter()
+    timings = {}
+    # prima riga letta prima del COPY: file/colonne non validi arrivano come ValueError, non come COPY fallito
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is not None:
+        rows = itertools.chain([first], rows)
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE import_stage (
+              ord BIGINT, project_id TEXT, description TEXT, geom_text TEXT
+            ) ON COMMIT DROP
+        """)
+        stream = _CopyStream(rows)
+        cur.copy_expert("COPY import_stage FROM STDIN WITH (FORMAT csv)", stream)
+        staged = stream.count
+        timings["copy_s"] = time.perf_counter() - t0
+
+        t = time.perf_counter()
+        cur.execute("""
+            CREATE TEMP TABLE import_projects ON COMMIT DROP AS
+            SELECT DISTINCT ON (project_id) project_id, description, g
+            FROM (
+              SELECT ord, trim(project_id)::bigint AS project_id, description,
+                     ST_Transform(ST_SetSRID(
+                       CASE WHEN left(ltrim(geom_text), 1) = '{'
+                            THEN ST_GeomFromGeoJSON(geom_text)
+                            ELSE ST_GeomFromText(geom_text) END, %s), 4326) AS g
+              FROM import_stage
+              WHERE NULLIF(trim(project_id), '') IS NOT NULL AND NULLIF(trim(geom_text), '') IS NOT NULL
+            ) s
+            ORDER BY project_id, ord DESC
+        """, (srid,))
+
+        # la colonna è MULTIPOLYGON: scarto vuoti, punti e linee
+        cur.execute("""
+            DELETE FROM import_projects
+            WHERE g IS NULL OR ST_IsEmpty(g) OR ST_Dimension(g) <> 2
+            RETURNING project_id
+        """)
+        rejected = [r[0] for r in cur.fetchall()]
+        cur.execute("SELECT count(*) FROM import_stage WHERE NULLIF(trim(project_id), '') IS NULL OR NULLIF(trim(geom_text), '') IS NULL")
+        missing = cur.fetchone()[0]
+
+        cur.execute("""
+            INSERT INTO saved_projects(project_id, description, geom, updated_at)
+            SELECT project_id, COALESCE(description, ''),
+                   ST_Multi(ST_CollectionExtract(ST_Force2D(g), 3)), NOW()
+            FROM import_projects
+            ON CONFLICT (project_id) DO UPDATE
+            SET description=EXCLUDED.description,
+                geom=EXCLUDED.geom,
+                updated_at=NOW()
+            RETURNING (xmax = 0)
+        """)
+        merged = [r[0] for r in cur.fetchall()]
+        # geometrie cambiate: le pericolosità salvate non valgono più, anche se l'analisi non viene rifatta
+        cur.execute("""
+            DELETE FROM project_hazards h
+            USING import_projects p
+            WHERE h.project_id = p.project_id
+        """)
+        timings["merge_s"] = time.perf_counter() - t
+
+        analysis = None
+        if layers is not None:
+            t = time.perf_counter()
+            analysis = _analyze(cur, layers, db_srid)
+            cur.execute("""
+                SELECT h.bacino, h.table_name, h.pericolosita, count(*)
+                FROM project_hazards h
+                JOIN import_projects p ON p.project_id = h.project_id
+                GROUP BY h.bacino, h.table_name, h.pericolosita
+                ORDER BY h.bacino, h.table_name, h.pericolosita
+            """)
+            analysis["by_class"] = [
+                {"bacino": b, "table": tb, "pericolosita": per, "projects": int(n)}
+                for b, tb, per, n in cur.fetchall()
+            ]
+            cur.execute("SELECT count(DISTINCT h.project_id) FROM project_hazards h JOIN import_projects p USING (project_id)")
+            analysis["projects_with_hits"] = int(cur.fetchone()[0])
+            timings["analyze_s"] = time.perf_counter() - t
+
+    elapsed = time.perf_counter() - t0
+    return {
+        "rows": staged,
+        "imported": len(merged),
+        "inserted": sum(1 for x in merged if x),
+        "updated": sum(1 for x in merged if not x),
+        "duplicates": staged - missing - len(merged) - len(rejected),
+        "skipped_missing": int(missing),
+        "rejected_non_polygonal": len(rejected),
+        "rejected_sample": rejected[:REJECTED_SAMPLE],
+        "analysis": analysis,
+        "timings": {k: round(v, 3) for k, v in timings.items()},
+        "elapsed_s": round(elapsed, 3),
+        "rows_per_s": round(staged / elapsed, 1) if elapsed > 0 else None,
+        "copy_rows_per_s": round(staged / timings["copy_s"], 1) if timings["copy_s"] > 0 else None,
+    }
@@ -0,0 +1,157 @@
+import os
+
+from psycopg2.extras import execute_values
+
+from .db import layer_versions
+
+GRID_RESOLUTIONS = [int(r) for r in os.getenv("STATS_GRID_RESOLUTIONS", "1000,5000").split(",") if r.strip()]
+COMUNI_TABLE = os.getenv("STATS_COMUNI_TABLE", "")          # opzionale, es. istat_comuni
+COMUNI_NAME_COL = os.getenv("STATS_COMUNI_NAME_COL", "comune")
+COMUNI_GEOM_COL = os.getenv("STATS_COMUNI_GEOM_COL", "geom")
+
+
+def ensure_stats_tables(cur):
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS stats_pai_layer (
+        table_name TEXT NOT NULL,
+        layer_version TEXT NOT NULL,
+        bacino TEXT,
+        studio TEXT,
+        classe TEXT NOT NULL,
+        feature_count BIGINT NOT NULL,
+        area_m2 DOUBLE PRECISION NOT NULL,
+        bbox4326 DOUBLE PRECISION[],
+        refreshed_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
+        PRIMARY KEY (table_name, classe)
+      )
+    """)
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS stats_pai_grid (
+        table_name TEXT NOT NULL,
+        resolution_m INTEGER NOT NULL,
+        i INTEGER NOT NULL,
+        j INTEGER NOT NULL,
+        classe TEXT NOT NULL,
+        feature_count BIGINT NOT NULL,
+        area_m2 DOUBLE PRECISION NOT NULL,
+        geom geometry(POLYGON, 4326),
+        PRIMARY KEY (table_name, resolution_m, i, j, classe)
+      )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS stats_pai_grid_geom_gist ON stats_pai_grid USING GIST (geom)")
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS stats_pai_comune (
+        table_name TEXT NOT NULL,
+        comune TEXT NOT NULL,
+        classe TEXT NOT NULL,
+        feature_count BIGINT NOT NULL,
+        area_m2 DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (table_name, comune, classe)
+      )
+    """)
+    # una riga per layer elaborato, anche senza classi o fallito: altrimenti resterebbe "stale" per sempre
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS stats_pai_refresh (
+        table_name TEXT PRIMARY KEY,
+        layer_version TEXT NOT NULL,
+        refreshed_at TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW(),
+        error TEXT
+      )
+    """)
+
+
+def _delete_layer(cur, table: str):
+    for t in ("stats_pai_layer", "stats_pai_grid", "stats_pai_comune"):
+        cur.execute(f"DELETE FROM {t} WHERE table_name=%s", (table,))
+
+
+def mark_layer(cur, table: str, error: str = None, version: str = None):
+    """Registra la versione elaborata (con l'eventuale errore): il layer non è stale finché i dati non cambiano."""
+    version = version or layer_versions(cur, [table]).get(table)
+    cur.execute("""
+        INSERT INTO stats_pai_refresh (table_name, layer_version, refreshed_at, error)
+        VALUES (%s, %s, NOW(), %s)
+        ON CONFLICT (table_name) DO UPDATE
+        SET layer_version=EXCLUDED.layer_version, refreshed_at=NOW(), error=EXCLUDED.error
+    """, (table, version, error))
+
+
+def _comuni_available(cur) -> bool:
+    if not COMUNI_TABLE:
+        return False
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"public.{COMUNI_TABLE}",))
+    return bool(cur.fetchone()[0])
+
+
+def refresh_layer(cur, table: str, geom_col: str, class_col: str, bacino: str, studio_of, srid: int):
+    """
+    Ricalcola i riepiloghi di un solo layer (conteggio, area, bbox per classe;
+    griglie a STATS_GRID_RESOLUTIONS metri; comuni se STATS_COMUNI_TABLE esiste).
+    L'area è la somma delle aree delle feature: eventuali sovrapposizioni
+    nello stesso layer sono contate due volte.
+    """
+    version = layer_versions(cur, [table]).get(table)
+    _delete_layer(cur, table)
+
+    # geometrie invalide (frequenti nei GeoPackage PAI) farebbero fallire ST_Intersection con TopologyException
+    src = f"""
+        SELECT {class_col}::text AS cls,
+               CASE WHEN ST_IsValid({geom_col}) THEN {geom_col} ELSE ST_MakeValid({geom_col}) END AS g
+        FROM {table}
+        WHERE {geom_col} IS NOT NULL AND {class_col} IS NOT NULL
+    """
+
+    cur.execute(f"""
+        SELECT cls, n, area, ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+        FROM (
+          SELECT cls, count(*) AS n, COALESCE(sum(ST_Area(g)), 0) AS area,
+                 ST_Transform(ST_SetSRID(ST_Extent(g)::geometry, {srid}), 4326) AS e
+          FROM ({src}) s
+          GROUP BY cls
+        ) x
+    """)
+    rows = cur.fetchall()
+    execute_values(cur, """
+        INSERT INTO stats_pai_layer (table_name, layer_version, bacino, studio, classe, feature_count, area_m2, bbox4326)
+        VALUES %s
+    """, [(table, version, bacino, studio_of(cls), cls, n, area, list(bbox)) for cls, n, area, *bbox in rows])
+
+    for res in GRID_RESOLUTIONS:
+        cur.execute(f"""
+            INSERT INTO stats_pai_grid (table_name, resolution_m, i, j, classe, feature_count, area_m2, geom)
+            SELECT %s, {res}, c.i, c.j, s.cls, count(*),
+                   sum(ST_Area(ST_Intersection(s.g, c.geom))),
+                   ST_Transform(ST_MakeEnvelope(c.i * {res}, c.j * {res}, (c.i + 1) * {res}, (c.j + 1) * {res}, {srid}), 4326)
+            FROM ({src}) s
+            CROSS JOIN LATERAL ST_SquareGrid({res}, s.g) c
+            WHERE ST_Intersects(s.g, c.geom)
+            GROUP BY c.i, c.j, s.cls
+        """, (table,))
+
+    if _comuni_available(cur):
+        cur.execute(f"""
+            INSERT INTO stats_pai_comune (table_name, comune, classe, feature_count, area_m2)
+            SELECT %s, m.{COMUNI_NAME_COL}::text, s.cls, count(*),
+                   sum(ST_Area(ST_Intersection(s.g, ST_Transform(m.{COMUNI_GEOM_COL}, {srid}))))
+            FROM ({src}) s
+            JOIN {COMUNI_TABLE} m ON ST_Intersects(s.g, ST_Transform(m.{COMUNI_GEOM_COL}, {srid}))
+            GROUP BY m.{COMUNI_NAME_COL}, s.cls
+        """, (table,))
+
+    mark_layer(cur, table, version=version)
+    return {"table": table, "version": version, "classes": len(rows)}
+
+
+def stale_layers(cur, tables):
+    """Layer senza riepilogo o con versione dati diversa da quella registrata, e riepiloghi orfani."""
+    current = layer_versions(cur, tables)
+    cur.execute("SELECT table_name, layer_version FROM stats_pai_refresh")
+    stored = dict(cur.fetchall())
+    stale = [t for t in tables if stored.get(t) != current.get(t)]
+    orphans = [t for t in stored if t not in current]
+    return stale, orphans
+
+
+def drop_layer(cur, table: str):
+    _delete_layer(cur, table)
+    cur.execute("DELETE FROM stats_pai_refresh WHERE table_name=%s", (table,))
@@ -0,0 +1,209 @@
+// Web Worker del feature store: fetch + JSON.parse fuori dal main thread,
+// persistenza IndexedDB e dedupe per (tabella, id feature).
+//
+// Messaggi in ingresso:
+//   { type: "load", reqId, apiBase, table, version, tiles: [{ key, bbox }], pageSize }
+//   { type: "clear", table }
+// Messaggi in uscita:
+//   { type: "features", reqId, table, features }   // solo feature mai inviate prima
+//   { type: "done", reqId, table, stats }
+//   { type: "error", reqId, table, error }
+
+const DB_NAME = "pai-feature-store";
+const DB_VERSION = 1;
+const CONCURRENCY = 4;
+const MAX_RETRIES = 3;   // 429/503 dal controllo di carico: riprova dopo Retry-After
+
+let dbPromise = null;
+const sent = new Map();      // table -> Set(id) già consegnati al main thread
+const versions = new Map();  // table -> version corrente
+const generations = new Map();  // table -> contatore di "clear": i load avviati prima si fermano
+
+function openDb() {
+  if (dbPromise) return dbPromise;
+  dbPromise = new Promise((resolve, reject) => {
+    const req = indexedDB.open(DB_NAME, DB_VERSION);
+    req.onupgradeneeded = () => {
+      const db = req.result;
+      const f = db.createObjectStore("features", { keyPath: "key" });
+      f.createIndex("table", "table");
+      const t = db.createObjectStore("tiles", { keyPath: "key" });
+      t.createIndex("table", "table");
+      db.createObjectStore("meta", { keyPath: "table" });
+    };
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  }).catch(() => null);  // IndexedDB non disponibile (es. navigazione privata): solo memoria
+  return dbPromise;
+}
+
+function idbReq(req) {
+  return new Promise((resolve, reject) => {
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+function txDone(tx) {
+  return new Promise((resolve, reject) => {
+    tx.oncomplete = () => resolve();
+    tx.onerror = () => reject(tx.error);
+    tx.onabort = () => reject(tx.error);
+  });
+}
+
+async function purgeTable(db, table) {
+  const tx = db.transaction(["features", "tiles", "meta"], "readwrite");
+  for (const store of ["features", "tiles"]) {
+    const idx = tx.objectStore(store).index("table");
+    const keys = await idbReq(idx.getAllKeys(IDBKeyRange.only(table)));
+    keys.forEach(k => tx.objectStore(store).delete(k));
+  }
+  tx.objectStore("meta").delete(table);
+  await txDone(tx);
+}
+
+async function checkVersion(db, table, version) {
+  if (versions.get(table) !== version) {
+    versions.set(table, version);
+    sent.set(table, new Set());
+  }
+  if (!db) return;
+  const meta = await idbReq(db.transaction("meta").objectStore("meta").get(table));
+  if (meta && meta.version === version) return;
+  await purgeTable(db, table);
+  const tx = db.transaction("meta", "readwrite");
+  tx.objectStore("meta").put({ table, version });
+  await txDone(tx);
+}
+
+function geomBbox(geom) {
+  let minx = Infinity, miny = Infinity, maxx = -Infinity, maxy = -Infinity;
+  const walk = (c) => {
+    if (typeof c[0] === "number") {
+      if (c[0] < minx) minx = c[0];
+      if (c[0] > maxx) maxx = c[0];
+      if (c[1] < miny) miny = c[1];
+      if (c[1] > maxy) maxy = c[1];
+      return;
+    }
+    for (const x of c) walk(x);
+  };
+  if (geom.type === "GeometryCollection") geom.geometries.forEach(g => walk(g.coordinates));
+  else walk(geom.coordinates);
+  return [minx, miny, maxx, maxy];
+}
+
+async function fetchWithRetry(url) {
+  for (let attempt = 0; ; attempt++) {
+    const r = await fetch(url, { headers: { "Accept": "application/json" } });
+    if ((r.status !== 429 && r.status !== 503) || attempt >= MAX_RETRIES) return r;
+    const wait = parseFloat(r.headers.get("Retry-After") || "1") * 1000 * (attempt + 1);
+    await new Promise(resolve => setTimeout(resolve, wait));
+  }
+}
+
+async function fetchTile(apiBase, table, tile, pageSize) {
+  const out = [];
+  let offset = 0;
+  while (true) {
+    const url = `${apiBase}/features?table=${encodeURIComponent(table)}&limit=${pageSize}&offset=${offset}&bbox=${tile.bbox.join(",")}`;
+    const r = await fetchWithRetry(url);
+    const txt = await r.text();
+    let j = null;
+    try { j = JSON.parse(txt); } catch(e) {}
+    if (!r.ok) throw new Error(j?.error || txt || ("HTTP " + r.status));
+
+    const feats = j?.fc?.features || [];
+    for (const f of feats) {
+      if (f.id == null) continue;
+      out.push({ key: `${table}|${f.id}`, table, id: String(f.id), bbox: geomBbox(f.geometry), feature: f });
+    }
+    offset += feats.length;
+    if (feats.length < pageSize) break;
+  }
+  return out;
+}
+
+async function readTile(db, table, version, tile) {
+  if (!db) return null;
+  const rec = await idbReq(db.transaction("tiles").objectStore("tiles").get(`${table}|${version}|${tile.key}`));
+  if (!rec) return null;
+
+  const s = sent.get(table);
+  const missing = rec.ids.filter(id => !s.has(id));
+  if (!missing.length) return [];
+  const store = db.transaction("features").objectStore("features");
+  const rows = await Promise.all(missing.map(id => idbReq(store.get(`${table}|${id}`))));
+  if (rows.some(r => !r)) return null;  // cache incompleta: ricarico dalla rete
+  return rows;
+}
+
+async function writeTile(db, table, version, tile, rows) {
+  if (!db) return;
+  const tx = db.transaction(["features", "tiles"], "readwrite");
+  const fs = tx.objectStore("features");
+  rows.forEach(r => fs.put(r));
+  tx.objectStore("tiles").put({ key: `${table}|${version}|${tile.key}`, table, ids: rows.map(r => r.id) });
+  await txDone(tx);
+}
+
+async function load(msg) {
+  const { reqId, apiBase, table, version, tiles, pageSize } = msg;
+  const gen = generations.get(table) || 0;
+  const cancelled = () => (generations.get(table) || 0) !== gen;
+  const db = await openDb();
+  await checkVersion(db, table, version);
+  const stats = { tiles: tiles.length, fromCache: 0, fromNetwork: 0, newFeatures: 0 };
+
+  const queue = tiles.slice();
+  const worker = async () => {
+    while (queue.length) {
+      const tile = queue.shift();
+      let rows = await readTile(db, table, version, tile);
+      if (rows) {
+        stats.fromCache++;
+      } else {
+        rows = await fetchTile(apiBase, table, tile, pageSize);
+        await writeTile(db, table, version, tile, rows);
+        stats.fromNetwork++;
+      }
+      if (versions.get(table) !== version) return;  // richiesta superata da un cambio versione
+      if (cancelled()) return;  // overlay pulito: le feature non vanno più consegnate né segnate come inviate
+
+      const s = sent.get(table);
+      const fresh = [];
+      for (const r of rows) {
+        if (s.has(r.id)) continue;   // feature a cavallo di più tile: una sola volta
+        s.add(r.id);
+        fresh.push({ id: r.id, bbox: r.bbox, feature: r.feature });
+      }
+      if (fresh.length) {
+        stats.newFeatures += fresh.length;
+        postMessage({ type: "features", reqId, table, features: fresh });
+      }
+    }
+  };
+
+  await Promise.all(Array.from({ length: CONCURRENCY }, worker));
+  if (cancelled()) return;
+  postMessage({ type: "done", reqId, table, stats });
+}
+
+onmessage = async (e) => {
+  const msg = e.data;
+  if (msg.type === "clear") {
+    // il main thread ha scartato le feature: vanno re-inviate (dalla cache locale) alla prossima vista
+    // e i caricamenti ancora in corso per la tabella si interrompono
+    generations.set(msg.table, (generations.get(msg.table) || 0) + 1);
+    sent.set(msg.table, new Set());
+    return;
+  }
+  if (msg.type === "load") {
+    try {
+      await load(msg);
+    } catch (err) {
+      postMessage({ type: "error", reqId: msg.reqId, table: msg.table, error: String(err?.message || err) });
+    }
+  }
+};
@@ -1 +1,87 @@
-﻿#!/usr/bin/env bashset -euo pipefail# ConfigPG_CONN='PG:"host=db dbname=gis user=postgres password=password"'GEOM_NAME="geom"# Lista bacini -> file gpkgdeclare -A GPKGGPKG[biferno]="/tmp/biferno.gpkg"GPKG[fortore]="/tmp/fortore.gpkg"GPKG[saccione]="/tmp/saccione.gpkg"GPKG[trigno]="/tmp/trigno.gpkg"GPKG[volturno]="/tmp/volturno.gpkg"sanitize() {  # lower + replace non-alnum with underscore  echo "$1" | tr '[:upper:]' '[:lower:]' | sed -E 's/[^a-z0-9_]+/_/g' | sed -E 's/^_+|_+$//g'}list_layers() {  local gpkg="$1"  ogrinfo -ro -so "$gpkg" \    | awk -F': ' '/^[0-9]+: /{name=$2; sub(/ \(.*/, "", name); print name}'}for basin in "${!GPKG[@]}"; do  gpkg="${GPKG[$basin]}"  if [ ! -f "$gpkg" ]; then    echo "SKIP: $basin (missing $gpkg)"    continue  fi  echo "=== BASIN: $basin ==="  while IFS= read -r layer; do    [ -n "$layer" ] || continue    t_layer="$(sanitize "$layer")"    table="pai_${basin}__${t_layer}"    echo "IMPORT: $layer -> $table"    ogr2ogr -f PostgreSQL \      "$PG_CONN" \      "$gpkg" \      -nln "$table" \      -nlt PROMOTE_TO_MULTI \      -lco GEOMETRY_NAME="$GEOM_NAME" \      -overwrite \      "$layer"  done < <(list_layers "$gpkg")doneecho "DONE"
\ No newline at end of file
+﻿#!/usr/bin/env bash
+set -euo pipefail
+
+# Config
+PG_CONN='PG:"host=db dbname=gis user=postgres password=password"'
+GEOM_NAME="geom"
+
+# Opzione display: DISPLAY_GEOM=1 aggiunge a ogni layer la colonna geom_4326
+# (ST_Transform mantenuto da PostgreSQL, indice GiST proprio) usata da
+# /features, /intersections e /table_extent al posto di ST_Transform per riga.
+# DISPLAY_SIMPLIFY_M = tolleranza di semplificazione in metri (0 = nessuna).
+DISPLAY_GEOM="${DISPLAY_GEOM:-0}"
+DISPLAY_SIMPLIFY_M="${DISPLAY_SIMPLIFY_M:-0}"
+BACKEND_APP="${BACKEND_APP:-/app/app.py}"
+
+# LAYER_VERSION=1: dopo ogni import forza una nuova versione dati del layer
+# tramite il backend (richiede flask). Non serve con -overwrite: la tabella
+# ricreata ha un nuovo OID, che fa già parte della versione.
+LAYER_VERSION="${LAYER_VERSION:-0}"
+
+# ADVISE=1: dopo l'import controlla e corregge il layer (indice GiST,
+# geometrie invalide, CLUSTER, ANALYZE) con l'advisor del backend.
+ADVISE="${ADVISE:-0}"
+
+# STATS=1: a fine import aggiorna i riepiloghi /stats dei soli layer cambiati.
+STATS="${STATS:-0}"
+
+# Lista bacini -> file gpkg
+declare -A GPKG
+GPKG[biferno]="/tmp/biferno.gpkg"
+GPKG[fortore]="/tmp/fortore.gpkg"
+GPKG[saccione]="/tmp/saccione.gpkg"
+GPKG[trigno]="/tmp/trigno.gpkg"
+GPKG[volturno]="/tmp/volturno.gpkg"
+
+sanitize() {
+  # lower + replace non-alnum with underscore
+  echo "$1" | tr '[:upper:]' '[:lower:]' | sed -E 's/[^a-z0-9_]+/_/g' | sed -E 's/^_+|_+$//g'
+}
+
+list_layers() {
+  local gpkg="$1"
+  ogrinfo -ro -so "$gpkg" \
+    | awk -F': ' '/^[0-9]+: /{name=$2; sub(/ \(.*/, "", name); print name}'
+}
+
+for basin in "${!GPKG[@]}"; do
+  gpkg="${GPKG[$basin]}"
+  if [ ! -f "$gpkg" ]; then
+    echo "SKIP: $basin (missing $gpkg)"
+    continue
+  fi
+
+  echo "=== BASIN: $basin ==="
+  while IFS= read -r layer; do
+    [ -n "$layer" ] || continue
+    t_layer="$(sanitize "$layer")"
+    table="pai_${basin}__${t_layer}"
+    echo "IMPORT: $layer -> $table"
+    ogr2ogr -f PostgreSQL \
+      "$PG_CONN" \
+      "$gpkg" \
+      -nln "$table" \
+      -nlt PROMOTE_TO_MULTI \
+      -lco GEOMETRY_NAME="$GEOM_NAME" \
+      -overwrite \
+      "$layer"
+
+    if [ "$LAYER_VERSION" = "1" ]; then
+      flask --app "$BACKEND_APP" layer-version "$table"
+    fi
+
+    if [ "$DISPLAY_GEOM" = "1" ]; then
+      flask --app "$BACKEND_APP" display-geom "$table" --simplify-m "$DISPLAY_SIMPLIFY_M"
+    fi
+
+    if [ "$ADVISE" = "1" ]; then
+      flask --app "$BACKEND_APP" advisor --fix "$table"
+    fi
+  done < <(list_layers "$gpkg")
+done
+
+if [ "$STATS" = "1" ]; then
+  flask --app "$BACKEND_APP" stats-refresh
+fi
+
+echo "DONE"